@@ -15,8 +15,13 @@
 ## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
 
 from .parts import *
+from .cache import *
+from .metrics import *
+from .diagnostics import *
+from .images import *
 from .settings import *
 from .fetcher import *
+from .ipc import *
 from .embeds import *
 from .discord_bot import *
 from .cli import *
@@ -0,0 +1,143 @@
+## notashark - discord bot for King Arthur's Gold
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains in-memory caches used across the bot
+
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class TTLCache:
+    """LRU cache with expiration time of entries.
+    Concurrent fetches of the same missing key are coalesced into one
+    """
+
+    def __init__(self, max_size: int = None, ttl: int = None):
+        self.max_size = max_size or DEFAULT_CACHE_SIZE
+        self.ttl = ttl or DEFAULT_CACHE_TTL
+        # key: (expiration time, value). Most recently used keys go last
+        self.storage = OrderedDict()
+        # key: task that is currently fetching its value
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.storage)
+
+    def get(self, key, default=None):
+        """Get value of provided key, if its cached and not expired yet"""
+        entry = self.storage.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if entry[0] < monotonic():
+            self._evict(key)
+            self.misses += 1
+            return default
+
+        self.storage.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def is_full(self) -> bool:
+        """Check if cache has outgrown its size limit"""
+        return len(self.storage) > self.max_size
+
+    def _evict(self, key):
+        del self.storage[key]
+
+    def set(self, key, value):
+        """Cache provided value under provided key"""
+        if key in self.storage:
+            self._evict(key)
+        self.storage[key] = (monotonic() + self.ttl, value)
+        # Getting rid of least recently used entries
+        while self.storage and self.is_full():
+            self._evict(next(iter(self.storage)))
+
+    def invalidate(self, key):
+        """Remove provided key from cache"""
+        if key in self.storage:
+            self._evict(key)
+
+    async def _fetch(self, key, fetch):
+        try:
+            value = await fetch()
+        finally:
+            del self.pending[key]
+        self.set(key, value)
+        return value
+
+    async def get_or_fetch(self, key, fetch):
+        """Get value of provided key from cache. If its not there - get it by
+        awaiting result of provided fetch() callable and cache it.
+        If such fetch is already in progress, its result is awaited instead
+        """
+        # Not using self.get(), coz cached value may be None
+        entry = self.storage.get(key)
+        if entry is not None and entry[0] >= monotonic():
+            self.storage.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self.pending.get(key)
+        if task is None:
+            log.debug(f"Fetching {key}, since its not in cache")
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            # Avoiding "exception was never retrieved" if all waiters are gone
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.pending[key] = task
+        else:
+            log.debug(f"Fetch of {key} is already in progress, waiting for it")
+
+        # Shielding, so cancellation of one waiter doesnt affect others
+        return await asyncio.shield(task)
+
+
+class BytesCache(TTLCache):
+    """TTLCache of binary values, limited by their total size in bytes"""
+
+    def __init__(self, max_bytes: int = None, ttl: int = None):
+        super().__init__(ttl=ttl)
+        self.max_bytes = max_bytes or DEFAULT_CACHE_BYTES
+        self.size = 0
+
+    def is_full(self) -> bool:
+        return self.size > self.max_bytes
+
+    def _evict(self, key):
+        self.size -= len(self.storage[key][1])
+        super()._evict(key)
+
+    def set(self, key, value: bytes):
+        """Cache provided value under provided key, unless its too big"""
+        if len(value) > self.max_bytes:
+            log.debug(f"Not caching {key}, coz its bigger than cache itself")
+            self.invalidate(key)
+            return
+        self.size += len(value)
+        super().set(key, value)
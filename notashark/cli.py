@@ -16,9 +16,11 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
 
-from notashark import fetcher, settings, discord_bot
+from notashark import fetcher, settings, discord_bot, ipc, metrics, diagnostics
 import argparse
+import asyncio
 from os import environ
+from os.path import basename, dirname, join
 from sys import exit
 import logging
 from logging.handlers import RotatingFileHandler
@@ -86,12 +88,172 @@ def main():
             f"value, which is {fetcher.DEFAULT_AUTOUPDATE_TIME} seconds"
         ),
     )
+    ap.add_argument(
+        "--serverlist-min-update-time",
+        type=int,
+        help=(
+            "Make interval between serverlist updates adaptive, with provided "
+            "minimum (in seconds). Servers are updated more often while they "
+            "change frequently, and less often while they dont. Could not be "
+            f"less than {fetcher.DEFAULT_MIN_AUTOUPDATE_TIME} seconds"
+        ),
+    )
+    ap.add_argument(
+        "--serverlist-max-update-time",
+        type=int,
+        help=(
+            "Make interval between serverlist updates adaptive, with provided "
+            "maximum (in seconds). Default maximum is "
+            f"{fetcher.DEFAULT_MAX_AUTOUPDATE_TIME} seconds"
+        ),
+    )
+    ap.add_argument(
+        "--serverlist-max-staleness",
+        type=int,
+        help=(
+            "Max amount of seconds autoupdating serverlist may stay unedited, "
+            "if its content didnt change. Default is "
+            f"{discord_bot.DEFAULT_SERVERLIST_MAX_STALENESS} seconds"
+        ),
+    )
+    ap.add_argument(
+        "--serverlist-concurrency",
+        type=int,
+        help=(
+            "Max amount of autoupdating serverlists that may be edited at once. "
+            f"Default is {discord_bot.DEFAULT_SERVERLIST_CONCURRENCY}"
+        ),
+    )
+    ap.add_argument(
+        "--leaderboards-update-time",
+        type=int,
+        help=(
+            "Custom lengh (in seconds) of pause between updates of each "
+            "kagstats leaderboard. Default is "
+            f"{fetcher.DEFAULT_LEADERBOARDS_UPDATE_TIME} seconds"
+        ),
+    )
+    ap.add_argument(
+        "--reuse-minimap-urls",
+        action="store_true",
+        help=(
+            "Reuse urls of already uploaded minimaps for requests of the same "
+            "server's map, instead of uploading them again"
+        ),
+    )
+    ap.add_argument(
+        "--optimize-minimaps",
+        action="store_true",
+        help=(
+            "Re-encode minimaps to reduce their size before uploading them. "
+            "Requires Pillow to be installed"
+        ),
+    )
+    ap.add_argument(
+        "--minimap-max-size",
+        help=(
+            "Downscale optimized minimaps to fit into provided dimensions, "
+            "in WIDTHxHEIGHT format. Either side can be omitted, e.g '800x'"
+        ),
+    )
+    ap.add_argument(
+        "--shards",
+        default="1",
+        help=(
+            "Total amount of shards, bot's guilds are split between. Either "
+            "a number or 'auto', to use amount recommended by discord. "
+            "Default is 1"
+        ),
+    )
+    ap.add_argument(
+        "--shard-ids",
+        help=(
+            "Comma-separated ids of shards, ran by this instance, e.g '0,1'. "
+            "Requires numeric --shards. By default all shards are ran. "
+            "Instances sharing settings should use sqlite settings backend"
+        ),
+    )
+    ap.add_argument(
+        "--sync-commands",
+        action="store_true",
+        help=(
+            "Register slash commands with discord on launch. Only needed once "
+            "after they have been changed, coz syncing is rate-limited"
+        ),
+    )
+    ap.add_argument(
+        "--fetcher-only",
+        action="store_true",
+        help=(
+            "Only run data fetcher, sharing its data with bot processes over "
+            "unix socket, specified via --fetcher-socket. Doesnt need token"
+        ),
+    )
+    ap.add_argument(
+        "--fetcher-socket",
+        help=(
+            "Path to unix socket of shared data fetcher. If specified without "
+            "--fetcher-only, bot will get its data from fetcher process on "
+            "that socket, instead of querying apis by itself. Default is "
+            f"{ipc.DEFAULT_FETCHER_SOCKET}"
+        ),
+    )
+    ap.add_argument(
+        "--metrics-port",
+        type=int,
+        help=(
+            "Serve prometheus-style metrics over http on provided port. "
+            "Disabled by default"
+        ),
+    )
+    ap.add_argument(
+        "--metrics-host",
+        help=(
+            "Address to serve metrics on. Default is "
+            f"{metrics.DEFAULT_METRICS_HOST}"
+        ),
+    )
+    ap.add_argument(
+        "--profile-loop",
+        help=(
+            "Diagnose event loop: log its lag, stacks of callbacks blocking it "
+            "and sample stacks of all threads. Sampled profile is dumped into "
+            "current directory on SIGUSR1, in collapsed stacks format"
+        ),
+        action="store_true",
+    )
+    ap.add_argument(
+        "--profile-loop-threshold",
+        type=float,
+        help=(
+            "Amount of seconds callback should block event loop for, to be "
+            "reported by --profile-loop. Default is "
+            f"{diagnostics.DEFAULT_BLOCK_THRESHOLD} seconds"
+        ),
+    )
+    ap.add_argument(
+        "--request-timeout",
+        type=int,
+        help=(
+            "Custom timeout (in seconds) of requests to kag-related apis. "
+            f"Default is {fetcher.DEFAULT_REQUEST_TIMEOUT} seconds"
+        ),
+    )
+    ap.add_argument(
+        "--connections-per-host",
+        type=int,
+        help=(
+            "Maximum amount of simultaneous connections to each of kag-related "
+            f"apis. Default is {fetcher.DEFAULT_CONNECTIONS_PER_HOST}"
+        ),
+    )
     ap.add_argument(
         "--settings-autosave-time",
         type=int,
         help=(
-            "Custom lengh (in seconds) of pause between autosaving per-server "
-            "settings on disk. Could not be less than default value, which is "
+            "Max amount of seconds changes to per-server settings may stay "
+            "unsaved. Settings are saved shortly after being changed, thus "
+            f"this only matters on frequent changes. Default is "
             f"{settings.DEFAULT_AUTOSAVE_TIME} seconds"
         ),
     )
@@ -104,9 +266,38 @@ def main():
         ),
     )
     # TODO: maybe add arg to override log file location/name?
+    ap.add_argument(
+        "--settings-backend",
+        choices=("json", "sqlite"),
+        default="json",
+        help=(
+            "Storage of per-server settings. Sqlite one only writes changed "
+            "entries, thus is preferable for large amount of servers. "
+            "Default is json"
+        ),
+    )
     ap.add_argument(
         "--settings-file",
-        help="Custom path to settings file",
+        help=(
+            "Custom path to settings file. Default is "
+            f"{settings.DEFAULT_SETTINGS_FILE} for json backend and "
+            f"{settings.DEFAULT_SETTINGS_DB} for sqlite one"
+        ),
+    )
+    ap.add_argument(
+        "--migrate-settings",
+        metavar="JSON_FILE",
+        help=(
+            "Import settings from provided json file into sqlite database, "
+            "specified via --settings-file, then exit"
+        ),
+    )
+    ap.add_argument(
+        "--countries-file",
+        help=(
+            "Custom path to file with cached countries of servers. "
+            "By default its stored next to settings file"
+        ),
     )
     args = ap.parse_args()
 
@@ -120,8 +311,21 @@ def main():
         show_terminal_info = args.show_logs,
     )
 
+    if args.migrate_settings:
+        db_file = args.settings_file or settings.DEFAULT_SETTINGS_DB
+        try:
+            amount = settings.migrate_settings(args.migrate_settings, db_file)
+        except Exception as e:
+            log.critical(
+                f"Unable to migrate settings from {args.migrate_settings} "
+                f"to {db_file}: {e}\nAbort"
+            )
+            exit(1)
+        log.info(f"Successfully migrated {amount} entries into {db_file}")
+        exit(0)
+
     bot_token = args.token or environ.get("NOTASHARK_DISCORD_KEY", None)
-    if not bot_token:
+    if not bot_token and not args.fetcher_only:
         log.critical(
             "You didnt specify bot's token! Either set NOTASHARK_DISCORD_KEY "
             "environment variable, or pass it via --token launch argument!\nAbort"
@@ -134,31 +338,164 @@ def main():
         and args.serverlist_update_time > fetcher.DEFAULT_AUTOUPDATE_TIME
         else fetcher.DEFAULT_AUTOUPDATE_TIME
     )
-    log.info(
-        f"Serverlist will autoupdate each {servers_autoupdate_time} seconds"
-    )
+    servers_scheduler = None
+    if args.serverlist_min_update_time or args.serverlist_max_update_time:
+        servers_scheduler = fetcher.PollScheduler(
+            min_time=max(
+                args.serverlist_min_update_time or 0,
+                fetcher.DEFAULT_MIN_AUTOUPDATE_TIME,
+            ),
+            max_time=args.serverlist_max_update_time,
+            initial_time=servers_autoupdate_time,
+        )
+        log.info(
+            "Serverlist will autoupdate each "
+            f"{servers_scheduler.min_time}-{servers_scheduler.max_time} seconds"
+        )
+    else:
+        log.info(
+            f"Serverlist will autoupdate each {servers_autoupdate_time} seconds"
+        )
 
     settings_autosave_time = (
         args.settings_autosave_time
-        if args.settings_autosave_time
-        and args.settings_autosave_time > settings.DEFAULT_AUTOSAVE_TIME
+        if args.settings_autosave_time and args.settings_autosave_time > 0
         else settings.DEFAULT_AUTOSAVE_TIME
     )
-    log.info(f"Settings will autosave each {settings_autosave_time} seconds")
+    log.info(
+        f"Settings changes will be saved in at most {settings_autosave_time} "
+        "seconds"
+    )
+
+    minimap_max_size = None
+    if args.minimap_max_size:
+        try:
+            minimap_max_size = tuple(
+                int(x) if x else None
+                for x in args.minimap_max_size.lower().split("x")
+            )
+            if len(minimap_max_size) != 2:
+                raise ValueError
+        except ValueError:
+            log.critical(
+                f"Invalid minimap size: {args.minimap_max_size}! "
+                "Expected format is WIDTHxHEIGHT\nAbort"
+            )
+            exit(1)
+
+    try:
+        shard_count = None if args.shards == "auto" else int(args.shards)
+        if shard_count is not None and shard_count < 1:
+            raise ValueError
+    except ValueError:
+        log.critical(
+            f"Invalid amount of shards: {args.shards}! "
+            "Expected positive number or 'auto'\nAbort"
+        )
+        exit(1)
 
-    # Configuring instances of manager and fetcher to use our settings
+    shard_ids = None
+    if args.shard_ids:
+        try:
+            if shard_count is None:
+                raise ValueError("--shard-ids require numeric --shards")
+            shard_ids = [int(x) for x in args.shard_ids.split(",")]
+            if not all(0 <= x < shard_count for x in shard_ids):
+                raise ValueError(f"ids should be in range 0-{shard_count - 1}")
+        except ValueError as e:
+            log.critical(f"Invalid shard ids: {args.shard_ids}! {e}\nAbort")
+            exit(1)
+        log.info(f"Running shards {shard_ids} of {shard_count}")
+
+        if args.settings_backend == "json":
+            log.warning(
+                "Multiple instances sharing json settings will overwrite each "
+                "other's changes. Consider using sqlite settings backend"
+            )
+
+    if args.settings_backend == "sqlite":
+        settings_file = args.settings_file or settings.DEFAULT_SETTINGS_DB
+    else:
+        settings_file = args.settings_file or settings.DEFAULT_SETTINGS_FILE
+
+    countries_file = args.countries_file or join(
+        dirname(settings_file),
+        basename(fetcher.DEFAULT_COUNTRIES_FILE),
+    )
+
+    # Configuring instance of fetcher to use our settings
+    if args.fetcher_socket and not args.fetcher_only:
+        log.info(f"Using shared data fetcher on {args.fetcher_socket}")
+        api_fetcher = ipc.RemoteApiFetcher(
+            socket_file=args.fetcher_socket,
+            autoupdate_time=servers_autoupdate_time,
+        )
+    else:
+        api_fetcher = fetcher.AsyncApiFetcher(
+            autoupdate_time=servers_autoupdate_time,
+            request_timeout=args.request_timeout,
+            connections_per_host=args.connections_per_host,
+            country_cache=fetcher.CountryCache(cache_file=countries_file),
+            leaderboards_update_time=args.leaderboards_update_time,
+            optimize_minimaps=args.optimize_minimaps,
+            minimap_max_size=minimap_max_size,
+            scheduler=servers_scheduler,
+        )
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = metrics.MetricsServer(
+            port=args.metrics_port,
+            host=args.metrics_host,
+        )
+
+    loop_profiler = None
+    if args.profile_loop:
+        loop_profiler = diagnostics.LoopProfiler(
+            threshold=args.profile_loop_threshold,
+        )
+
+    if args.fetcher_only:
+        server = ipc.FetcherServer(
+            api_fetcher=api_fetcher,
+            socket_file=args.fetcher_socket,
+        )
+        try:
+            asyncio.run(
+                ipc.serve_fetcher(server, metrics_server, loop_profiler)
+            )
+        except Exception as e:
+            log.critical(f"Unable to run data fetcher: {e}")
+            exit(1)
+        return
+
+    if args.settings_backend == "sqlite":
+        try:
+            settings_backend = settings.SqliteBackend(settings_file)
+        except Exception as e:
+            log.critical(f"Unable to open {settings_file}: {e}\nAbort")
+            exit(1)
+    else:
+        settings_backend = settings.JsonBackend(settings_file)
+
+    # Configuring instance of manager to use our settings
     settings_manager = settings.SettingsManager(
         autosave_time=settings_autosave_time,
-        settings_file=args.settings_file or settings.DEFAULT_SETTINGS_FILE,
-    )
-    api_fetcher = fetcher.ApiFetcher(
-        autoupdate_time=servers_autoupdate_time,
+        backend=settings_backend,
     )
 
     # Passing our pre-configured instances to bot
     bot = discord_bot.make_bot(
         settings_manager=settings_manager,
         api_fetcher=api_fetcher,
+        serverlist_max_staleness=args.serverlist_max_staleness,
+        serverlist_concurrency=args.serverlist_concurrency,
+        reuse_minimap_urls=args.reuse_minimap_urls,
+        shard_count=shard_count,
+        shard_ids=shard_ids,
+        sync_commands=args.sync_commands,
+        metrics_server=metrics_server,
+        loop_profiler=loop_profiler,
     )
     bot.run(bot_token)
 
@@ -0,0 +1,234 @@
+## notashark - discord bot for King Arthur's Gold
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains diagnostics of event loop: lag measurement, detection
+# of blocking callbacks and sampling profiler
+
+import asyncio
+import logging
+import signal
+import sys
+import threading
+import traceback
+from collections import Counter
+from os.path import join
+from time import monotonic, sleep, strftime
+
+log = logging.getLogger(__name__)
+
+# Callbacks blocking event loop for longer than that (in seconds) are reported
+DEFAULT_BLOCK_THRESHOLD = 0.1
+DEFAULT_PROFILES_DIR = "."
+# Amount of seconds between heartbeats of event loop
+HEARTBEAT_INTERVAL = 0.05
+# Amount of seconds between samples of threads' stacks
+SAMPLE_INTERVAL = 0.01
+# Amount of seconds between reports of event loop's lag
+LAG_REPORT_INTERVAL = 60
+# Max amount of different stacks kept by profiler, to limit its memory usage
+MAX_STACKS = 10000
+# Functions, event loop waits for events in. Samples of them are idle time
+LOOP_IDLE_FUNCTIONS = ("select", "poll", "epoll", "kqueue", "control")
+# Functions, other threads (executors' workers, discord.py's keep-alive) wait
+# for work in. These arent idle for event loop's thread, coz if its waiting
+# there - its blocked
+IDLE_FUNCTIONS = LOOP_IDLE_FUNCTIONS + ("wait", "_worker", "get")
+
+
+def collapse_stack(frame) -> str:
+    """Get stack of provided frame in collapsed format, root frame first"""
+    entries = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        entries.append(f"{module}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(entries))
+
+
+class LoopProfiler:
+    """Diagnostics of event loop's responsiveness.
+    Measures lag of event loop, logs stack of event loop's thread each time
+    its blocked for longer than threshold, and samples stacks of all threads.
+    Sampled profile is dumped on SIGUSR1, in collapsed stacks format that can
+    be fed to flamegraph.pl or speedscope
+    """
+
+    def __init__(self, threshold: float = None, profiles_dir: str = None):
+        self.threshold = threshold or DEFAULT_BLOCK_THRESHOLD
+        self.profiles_dir = profiles_dir or DEFAULT_PROFILES_DIR
+        # These are set in self.start(), from within event loop
+        self.loop = None
+        self.loop_thread_id = None
+        self.heartbeat_task = None
+        self.last_beat = None
+        # Max and total lag and amount of heartbeats since last report
+        self.lag_stats = [0, 0, 0]
+        self.stopped = threading.Event()
+        self.threads = []
+        # Collapsed stack: amount of samples
+        self.samples = Counter()
+        self.idle_samples = 0
+        self.samples_locker = threading.Lock()
+
+    def start(self):
+        """Launch diagnostics. Should be called from within event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = monotonic()
+        self.stopped.clear()
+        self.heartbeat_task = asyncio.create_task(self.heartbeat_routine())
+        self.threads = [
+            threading.Thread(
+                target=target,
+                name=f"notashark-{name}",
+                daemon=True,
+            )
+            for name, target in (
+                ("watchdog", self.watchdog_routine),
+                ("sampler", self.sampler_routine),
+            )
+        ]
+        for thread in self.threads:
+            thread.start()
+
+        try:
+            self.loop.add_signal_handler(signal.SIGUSR1, self.dump_profile)
+        except (NotImplementedError, AttributeError):
+            # There is no SIGUSR1 on windows
+            log.warning("Unable to set SIGUSR1 handler, profile wont be dumped")
+
+        log.info(
+            "Profiling event loop. Callbacks blocking it for more than "
+            f"{self.threshold} seconds will be reported"
+        )
+
+    def close(self):
+        """Stop diagnostics"""
+        self.stopped.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        if self.loop is not None:
+            try:
+                self.loop.remove_signal_handler(signal.SIGUSR1)
+            except (NotImplementedError, AttributeError):
+                pass
+
+    async def heartbeat_routine(self):
+        """Routine that reports that event loop is alive and measures its lag.
+        Intended to be ran as asyncio task, see self.start()
+        """
+        last_report = monotonic()
+        while True:
+            started = monotonic()
+            self.last_beat = started
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            lag = max(monotonic() - started - HEARTBEAT_INTERVAL, 0)
+            self.lag_stats[0] = max(self.lag_stats[0], lag)
+            self.lag_stats[1] += lag
+            self.lag_stats[2] += 1
+
+            if monotonic() - last_report >= LAG_REPORT_INTERVAL:
+                max_lag, total_lag, beats = self.lag_stats
+                log.info(
+                    f"Event loop lag over last {LAG_REPORT_INTERVAL} seconds: "
+                    f"average {total_lag / beats * 1000:.2f}ms, "
+                    f"max {max_lag * 1000:.2f}ms"
+                )
+                self.lag_stats = [0, 0, 0]
+                last_report = monotonic()
+
+    def watchdog_routine(self):
+        """Routine that logs stack of event loop's thread, if its blocked.
+        Intended to be ran in separate thread, see self.start()
+        """
+        # Heartbeat of the block that has already been reported
+        reported_beat = None
+        while not self.stopped.wait(self.threshold / 2):
+            last_beat = self.last_beat
+            blocked_for = monotonic() - last_beat - HEARTBEAT_INTERVAL
+            if blocked_for < self.threshold or last_beat == reported_beat:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            reported_beat = last_beat
+            log.warning(
+                f"Event loop is blocked for {blocked_for:.3f} seconds at:\n"
+                + "".join(traceback.format_stack(frame))
+            )
+
+    def sampler_routine(self):
+        """Routine that samples stacks of all threads, skipping these that
+        wait for something to do.
+        Intended to be ran in separate thread, see self.start()
+        """
+        own_ids = {x.ident for x in self.threads}
+        names = {}
+        while not self.stopped.is_set():
+            sleep(SAMPLE_INTERVAL)
+            frames = sys._current_frames()
+            with self.samples_locker:
+                for thread_id, frame in frames.items():
+                    if thread_id in own_ids:
+                        continue
+                    if frame.f_code.co_name in (
+                        LOOP_IDLE_FUNCTIONS
+                        if thread_id == self.loop_thread_id
+                        else IDLE_FUNCTIONS
+                    ):
+                        self.idle_samples += 1
+                        continue
+
+                    if thread_id not in names:
+                        names = {x.ident: x.name for x in threading.enumerate()}
+                    stack = (
+                        f"{names.get(thread_id, thread_id)};"
+                        f"{collapse_stack(frame)}"
+                    )
+                    if stack in self.samples or len(self.samples) < MAX_STACKS:
+                        self.samples[stack] += 1
+
+    def dump_profile(self) -> str:
+        """Save sampled profile to file and start sampling from scratch.
+        Returns path to that file
+        """
+        with self.samples_locker:
+            samples = self.samples
+            idle_samples = self.idle_samples
+            self.samples = Counter()
+            self.idle_samples = 0
+
+        path = join(
+            self.profiles_dir,
+            f"notashark-profile-{strftime('%Y%m%d-%H%M%S')}.txt",
+        )
+        try:
+            with open(path, "w") as f:
+                for stack, amount in samples.most_common():
+                    f.write(f"{stack} {amount}\n")
+        except Exception as e:
+            log.error(f"Unable to dump profile to {path}: {e}")
+            return None
+
+        busy_samples = sum(samples.values())
+        log.info(
+            f"Dumped profile of {busy_samples} busy samples "
+            f"({idle_samples} idle ones skipped) to {path}"
+        )
+        return path
@@ -16,30 +16,75 @@
 
 # This module contains discord bot itaswell as directly related functionality
 
-from notashark import fetcher, settings, embeds
+from notashark import fetcher, settings, embeds, metrics, diagnostics
+import asyncio
 import discord
 import logging
-import threading
+import signal
 from sys import exit
+from discord import app_commands
 from discord.ext import commands, tasks
+from discord.utils import utcnow
+from random import uniform
+from time import monotonic, time
 from types import SimpleNamespace
 
 log = logging.getLogger(__name__)
 
+# Max amount of seconds serverlist may stay unedited if its content didnt change
+DEFAULT_SERVERLIST_MAX_STALENESS = 300
+# Max amount of serverlist edits that may be awaited at once
+DEFAULT_SERVERLIST_CONCURRENCY = 25
+# Pace of serverlist edits. Discord's global rate limit is 50 requests/second
+SERVERLIST_EDITS_PER_SECOND = 40
+# Part of autoupdate interval, serverlist update pass should fit into
+SERVERLIST_SPREAD_RATIO = 0.8
+# Amount of missed servers updates, after which serverlist is marked outdated
+SERVERLIST_STALE_UPDATES = 2
+# Amount of seconds leaderboard pages can be switched after being requested
+LEADERBOARD_VIEW_TIMEOUT = 300
+# Max amount of suggestions discord allows to show in autocomplete
+AUTOCOMPLETE_MAX_CHOICES = 25
 
-class Notashark(commands.Bot):
-    """Discord bot for King Arthur's Gold."""
+
+class Notashark(commands.AutoShardedBot):
+    """Discord bot for King Arthur's Gold.
+    By default runs as a single shard. Set shard_count to None to use amount
+    of shards recommended by discord, and shard_ids to only run some of them.
+    """
 
     def __init__(
         self,
         settings_manager: settings.SettingsManager = None,
-        api_fetcher: fetcher.ApiFetcher = None,
+        api_fetcher: fetcher.AsyncApiFetcher = None,
         command_prefix: str = "!",
         name: str = "notashark",
+        serverlist_max_staleness: int = None,
+        serverlist_concurrency: int = None,
+        reuse_minimap_urls: bool = False,
+        shard_count: int = 1,
+        shard_ids: list = None,
+        sync_commands: bool = False,
+        metrics_server: metrics.MetricsServer = None,
+        loop_profiler: diagnostics.LoopProfiler = None,
     ):
         self.settings_manager = settings_manager or settings.SettingsManager()
-        self.api_fetcher = api_fetcher or fetcher.ApiFetcher()
+        self.api_fetcher = api_fetcher or fetcher.AsyncApiFetcher()
         self.name = name
+        self.serverlist_max_staleness = (
+            serverlist_max_staleness or DEFAULT_SERVERLIST_MAX_STALENESS
+        )
+        self.serverlist_concurrency = (
+            serverlist_concurrency or DEFAULT_SERVERLIST_CONCURRENCY
+        )
+        self.reuse_minimap_urls = reuse_minimap_urls
+        # Syncing slash commands is heavily rate-limited, thus its only done
+        # on demand, e.g after commands have been changed
+        self.sync_commands = sync_commands
+        self.metrics_server = metrics_server
+        self.loop_profiler = loop_profiler
+        # Task of shutdown, initiated by SIGTERM. See self.on_sigterm()
+        self.close_task = None
 
         intents = discord.Intents.default()
         intents.messages = True
@@ -49,25 +94,20 @@ class Notashark(commands.Bot):
         super().__init__(
             command_prefix=command_prefix,
             intents=intents,
+            shard_count=shard_count,
+            shard_ids=shard_ids,
         )
 
+    def is_local_guild(self, guild_id: str) -> bool:
+        """Check if guild belongs to one of shards, ran by this instance"""
+        if self.shard_ids is None:
+            return True
+        # See https://discord.com/developers/docs/topics/gateway#sharding
+        return (int(guild_id) >> 22) % self.shard_count in self.shard_ids
+
     def run(self, token, **kwargs):
         """Run bot and related routines."""
         try:
-            log.debug("Launching data fetcher")
-            # daemon=True allows to shutdown this thing without w8ing for completion
-            dft = threading.Thread(
-                target=self.api_fetcher.autoupdate_routine,
-                daemon=True,
-            )
-            dft.start()
-
-            log.debug("Initializing settings manager")
-            sat = threading.Thread(
-                target=self.settings_manager.autosave_routine,
-            )
-            sat.start()
-
             log.debug(f"Launching {self.name}")
 
             # Since we've manually altered handlers in cli, disable default ones
@@ -79,6 +119,63 @@ class Notashark(commands.Bot):
             log.critical(f"Unable to initialize {self.name}: {e}")
             exit(1)
 
+    async def setup_hook(self):
+        """Launch data fetcher and settings autosave once event loop is up
+        and running.
+        """
+        if self.loop_profiler is not None:
+            self.loop_profiler.start()
+        log.debug("Initializing settings manager")
+        self.settings_manager.start()
+        log.debug("Launching data fetcher")
+        await self.api_fetcher.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+
+        if self.sync_commands:
+            log.info("Syncing slash commands")
+            try:
+                synced = await self.tree.sync()
+            except Exception as e:
+                log.error(f"Unable to sync slash commands: {e}")
+            else:
+                log.info(f"Successfully synced {len(synced)} slash commands")
+
+        # Shutting down gracefully on SIGTERM, thus settings get saved
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM,
+                self.on_sigterm,
+            )
+        except NotImplementedError:
+            # Signal handlers are not supported by event loops on windows
+            log.debug("Unable to set SIGTERM handler, ignoring")
+
+    def on_sigterm(self):
+        """Shutdown gracefully, unless shutdown is already in progress"""
+        if self.close_task is not None and not self.close_task.done():
+            log.debug("Already shutting down, ignoring SIGTERM")
+            return
+        # Keeping reference to task, coz event loop only keeps a weak one
+        self.close_task = asyncio.create_task(self.close())
+
+    async def close(self):
+        """Shutdown data fetcher alongside the bot itself.
+        Save unsaved settings changes, if there are any.
+        """
+        if self.is_closed():
+            return
+        log.info(f"Shutting down {self.name}")
+        await self.api_fetcher.close()
+        # Saving settings before closing the bot itself, coz once its closed -
+        # event loop may stop before save is done
+        await self.settings_manager.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.loop_profiler is not None:
+            self.loop_profiler.close()
+        await super().close()
+
     async def on_command_error(self, ctx, error):
         """Process command's error"""
 
@@ -95,18 +192,136 @@ class Notashark(commands.Bot):
             f"on {ctx.guild.id}/{ctx.channel.id} has raised an exception: "
             f"{type(error).__name__}: {error}"
         )
-        await ctx.channel.send(
+        await ctx.channel.send(self.get_error_message(error, ctx.command))
+        # #TODO: handle specific error types differently
+
+    def get_error_message(self, error: Exception, command: str) -> str:
+        """Get message to respond with on provided error of command"""
+        if isinstance(error, fetcher.UpstreamUnavailable):
+            return (
+                "Data source of this command is currently unavailable. "
+                "Please try again later"
+            )
+        return (
             "Something went wrong... "
-            f"Are you sure you are using '{ctx.command}' correctly?"
+            f"Are you sure you are using '{command}' correctly?"
         )
-        # #TODO: handle specific error types differently
+
+    def observe_interaction(
+        self, interaction: discord.Interaction, outcome: str
+    ):
+        """Record duration of slash command, since its been invoked by user"""
+        if interaction.command is None:
+            return
+        metrics.COMMANDS.observe(
+            (utcnow() - interaction.created_at).total_seconds(),
+            command=interaction.command.qualified_name,
+            kind="slash",
+            outcome=outcome,
+        )
+
+    async def on_app_command_completion(
+        self,
+        interaction: discord.Interaction,
+        command: app_commands.Command,
+    ):
+        self.observe_interaction(interaction, "success")
+
+    async def on_app_command_error(
+        self,
+        interaction: discord.Interaction,
+        error: app_commands.AppCommandError,
+    ):
+        """Process slash command's error"""
+        self.observe_interaction(interaction, "failure")
+        error = getattr(error, "original", error)
+        # Command is None if it didnt match any of registered ones, e.g if
+        # registrations are outdated coz commands havent been synced
+        if interaction.command is None:
+            name = (interaction.data or {}).get("name", "unknown")
+        else:
+            name = interaction.command.qualified_name
+        log.error(
+            f"Slash command '/{name}' by "
+            f"{interaction.user.id} on {interaction.guild_id}/"
+            f"{interaction.channel_id} has raised an exception: "
+            f"{type(error).__name__}: {error}"
+        )
+        if interaction.command is None or isinstance(
+            error, app_commands.CommandSignatureMismatch
+        ):
+            message = (
+                "This command is outdated. Please try again once it gets "
+                "updated"
+            )
+        else:
+            message = self.get_error_message(error, interaction.command.name)
+        try:
+            # Most of commands are deferred, thus they should be followed up
+            if interaction.response.is_done():
+                await interaction.followup.send(message)
+            else:
+                await interaction.response.send_message(message)
+        except Exception as e:
+            log.warning(f"Unable to respond with error message: {e}")
+
+
+class LeaderboardView(discord.ui.View):
+    """Buttons to navigate between pages of leaderboard."""
+
+    def __init__(self, pages: list, timeout: int = None):
+        super().__init__(timeout=timeout or LEADERBOARD_VIEW_TIMEOUT)
+        self.pages = pages
+        self.page = 0
+        # Message this view is attached to. Should be set after sending it
+        self.message = None
+        self.update_buttons()
+
+    def update_buttons(self):
+        """Disable buttons that would lead outside of available pages."""
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= len(self.pages) - 1
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        """Switch message this view is attached to to provided page."""
+        self.page = max(0, min(page, len(self.pages) - 1))
+        self.update_buttons()
+        await interaction.response.edit_message(
+            embed=self.pages[self.page],
+            view=self,
+        )
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show_page(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        """Remove buttons once they are no longer handled."""
+        if self.message is None:
+            return
+        try:
+            await self.message.edit(view=None)
+        except Exception as e:
+            log.debug(f"Unable to remove leaderboard buttons: {e}")
 
 
 def make_bot(
     settings_manager: settings.SettingsManager = None,
-    api_fetcher: fetcher.ApiFetcher = None,
+    api_fetcher: fetcher.AsyncApiFetcher = None,
     command_prefix: str = "!",
     name: str = "notashark",
+    serverlist_max_staleness: int = None,
+    serverlist_concurrency: int = None,
+    reuse_minimap_urls: bool = False,
+    shard_count: int = 1,
+    shard_ids: list = None,
+    sync_commands: bool = False,
+    metrics_server: metrics.MetricsServer = None,
+    loop_profiler: diagnostics.LoopProfiler = None,
 ):
     """Factory to create bot's instance with provided settings."""
     bot = Notashark(
@@ -114,12 +329,70 @@ def make_bot(
         api_fetcher=api_fetcher,
         command_prefix=command_prefix,
         name=name,
+        serverlist_max_staleness=serverlist_max_staleness,
+        serverlist_concurrency=serverlist_concurrency,
+        reuse_minimap_urls=reuse_minimap_urls,
+        shard_count=shard_count,
+        shard_ids=shard_ids,
+        sync_commands=sync_commands,
+        metrics_server=metrics_server,
+        loop_profiler=loop_profiler,
     )
+    bot.tree.on_error = bot.on_app_command_error
 
     # removing default help, coz its easier to make a new, than to fix a template
     bot.remove_command("help")
 
     converter = commands.TextChannelConverter()
+    # Revision and age (if outdated) of last rendered servers snapshot, embed
+    # rendered out of it,
+    # guild_id: (embed's fingerprint, time of edit) of last successful edits
+    # and guild_id: serverlist message handles
+    serverlist = SimpleNamespace(
+        revision=None,
+        age=None,
+        embed=None,
+        edits={},
+        messages={},
+    )
+
+    def parse_server_address(server_address: str) -> list:
+        """Get ip and port out of server address in various formats"""
+        # avoiding breakage on interactive uri
+        if server_address.startswith("<") and server_address.endswith(">"):
+            server_address = server_address[1 : (len(server_address) - 1)]
+        # support for kag:// uri
+        if server_address.startswith("kag://"):
+            server_address = server_address[6:]
+
+        return server_address.split(":")
+
+    async def get_servers_data():
+        """Get servers snapshot kept up to date by autoupdate routine.
+        Only falls back to fetching servers directly, if there is none yet
+        """
+        return (
+            bot.api_fetcher.kag_servers or await bot.api_fetcher.get_servers()
+        )
+
+    def remember_minimap_url(
+        server_info,
+        data,
+        message: discord.Message,
+    ):
+        """Remember url of minimap uploaded with message, to avoid uploading
+        it again. Only does anything if bot.reuse_minimap_urls is enabled
+        """
+        if (
+            bot.reuse_minimap_urls
+            and data.attachment is not None
+            and message.embeds
+            and message.embeds[0].image.url
+        ):
+            bot.api_fetcher.remember_minimap_url(
+                server_info,
+                message.embeds[0].image.url,
+            )
 
     async def update_status():
         """Update bot's status with current bot.api_fetcher.kag_servers data."""
@@ -134,9 +407,147 @@ def make_bot(
         except Exception as e:
             log.warning(f"Unable to update bot's status: {e}")
 
+    async def update_serverlist(guild_id: str, infobox: discord.Embed) -> bool:
+        """Push provided serverlist embed into guild's serverlist channel.
+        Returns True on success, False otherwise.
+        """
+        entry = bot.settings_manager.storage[guild_id]
+        chan_id = entry["serverlist_channel_id"]
+
+        # Reusing message handles between passes, instead of fetching message
+        # each time, coz that would cost an additional request per guild
+        message = serverlist.messages.get(guild_id)
+        if message is None and entry["serverlist_message_id"]:
+            # future reminder: serverlist_channel_id should always be int
+            channel = bot.get_channel(chan_id)
+            if channel is None:
+                log.warning(
+                    f"Unable to update serverlist on channel {chan_id}:"
+                    f"guild {guild_id} is unavailable"
+                )
+                return False
+            message = channel.get_partial_message(
+                entry["serverlist_message_id"]
+            )
+            serverlist.messages[guild_id] = message
+
+        if message is not None:
+            # Attempting to deal with issues caused by discord api being unavailable.
+            try:
+                with metrics.SERVERLIST_EDITS.time(action="edit"):
+                    await message.edit(content=None, embed=infobox)
+            except discord.errors.NotFound:
+                log.debug(
+                    "Unable to find existing message, configuring new one"
+                )
+                serverlist.messages.pop(guild_id, None)
+            except Exception as e:
+                log.warning(
+                    f"Unable to edit serverlist on {guild_id}/{chan_id}: {e}"
+                )
+                return False
+            else:
+                log.info(
+                    f"Successfully updated serverlist on {chan_id}/{message.id}"
+                )
+                return True
+
+        channel = bot.get_channel(chan_id)
+        if channel is None:
+            log.warning(
+                f"Unable to update serverlist on channel {chan_id}:"
+                f"guild {guild_id} is unavailable"
+            )
+            return False
+
+        try:
+            with metrics.SERVERLIST_EDITS.time(action="send"):
+                message = await channel.send(content=None, embed=infobox)
+        except Exception as e:
+            log.warning(
+                f"Unable to create new stats message on {guild_id}/{chan_id}: {e}"
+            )
+            return False
+
+        bot.settings_manager.set_serverlist_message(guild_id, message.id)
+        serverlist.messages[guild_id] = message
+        log.info(
+            f"Sent new serverlist msg to {guild_id}/{chan_id}/{message.id}"
+        )
+        return True
+
+    async def fan_out_serverlists(guilds: list, infobox: discord.Embed) -> list:
+        """Push provided serverlist embed into serverlists of provided guilds.
+        Edits are ran concurrently (up to bot.serverlist_concurrency at once) and
+        spread across jittered time slots, in order to avoid bursts that would
+        hit discord's rate limits. Per-route rate limit buckets themselves are
+        respected by discord.py's http client.
+        Returns list of results of update_serverlist() for each guild.
+        """
+        if not guilds:
+            return []
+
+        semaphore = asyncio.Semaphore(bot.serverlist_concurrency)
+        # Spreading edits, but ensuring the whole pass fits into part of
+        # autoupdate interval, even if there are lots of guilds
+        slot = min(
+            1 / SERVERLIST_EDITS_PER_SECOND,
+            (bot.api_fetcher.autoupdate_time * SERVERLIST_SPREAD_RATIO)
+            / len(guilds),
+        )
+
+        async def update_in_slot(position: int, guild_id: str) -> bool:
+            await asyncio.sleep(slot * position + uniform(0, slot))
+            async with semaphore:
+                return await update_serverlist(guild_id, infobox)
+
+        return await asyncio.gather(
+            *(update_in_slot(pos, guild) for pos, guild in enumerate(guilds)),
+            return_exceptions=True,
+        )
+
     async def update_serverlists():
         """Update serverlists on all servers that have this feature enabled."""
-        for item in bot.settings_manager.storage:
+        # Rendering embed only once per cycle out of snapshot that has been
+        # gathered by bot.api_fetcher.autoupdate_routine(), thus amount of
+        # requests to kag api doesnt depend on amount of configured guilds
+        data = bot.api_fetcher.kag_servers
+        if not data:
+            log.debug("No serverlist snapshot available yet, skipping")
+            return
+
+        # If servers couldnt be updated for a while - showing how old they are.
+        # Age is rounded to minutes, thus embed doesnt change on each pass
+        age = None
+        if data.timestamp is not None:
+            seconds = time() - data.timestamp
+            if (
+                seconds
+                > bot.api_fetcher.autoupdate_time * SERVERLIST_STALE_UPDATES
+            ):
+                age = int(seconds // 60)
+
+        # Only re-rendering embed if servers have changed since last time
+        if (
+            serverlist.embed is None
+            or data.revision != serverlist.revision
+            or age != serverlist.age
+        ):
+            serverlist.embed = embeds.make_servers_embed(data, age=age)
+            serverlist.revision = data.revision
+            serverlist.age = age
+        else:
+            log.debug("Servers didnt change, reusing previous serverlist embed")
+            # Timestamp isnt part of fingerprint, thus its safe to refresh it
+            serverlist.embed.timestamp = utcnow()
+        infobox = serverlist.embed
+        fingerprint = embeds.get_embed_fingerprint(infobox)
+        now = monotonic()
+
+        # Copying keys, coz storage may get new entries while we are awaiting
+        guilds = []
+        skipped = 0
+        for item in list(bot.settings_manager.storage):
             # avoiding entries without serverlist_channel_id being set
             if (
                 not bot.settings_manager.storage[item]
@@ -146,70 +557,82 @@ def make_bot(
             ):
                 continue
 
-            chan_id = bot.settings_manager.storage[item][
-                "serverlist_channel_id"
-            ]
+            # Guilds of other shards are handled by other instances of bot
+            if not bot.is_local_guild(item):
+                continue
 
-            try:
-                # future reminder: serverlist_channel_id should always be int
-                channel = bot.get_channel(chan_id)
-                message = await channel.fetch_message(
-                    bot.settings_manager.storage[item]["serverlist_message_id"]
-                )
-            except AttributeError:
-                log.warning(
-                    f"Unable to update serverlist on channel {chan_id}:"
-                    f"guild {item} is unavailable"
-                )
+            # Avoiding edits of serverlists that already show the same data,
+            # unless they have been last edited too long ago
+            last_edit = serverlist.edits.get(item)
+            if (
+                last_edit
+                and last_edit[0] == fingerprint
+                and (now - last_edit[1]) < bot.serverlist_max_staleness
+            ):
+                log.debug(f"Serverlist on {item} is up to date, skipping")
+                skipped += 1
                 continue
-            except (discord.errors.NotFound, discord.errors.HTTPException):
-                log.debug(
-                    "Unable to find existing message, configuring new one"
-                )
-                try:
-                    channel = bot.get_channel(chan_id)
-                    message = await channel.send("Gathering the data...")
-                except Exception as e:
-                    log.warning(
-                        f"Unable to create new stats message on {item}/{chan_id}: {e}"
-                    )
-                    continue
-                else:
-                    log.debug(
-                        f"Sent placeholder serverlist msg to {item}/{channel.id}"
-                    )
-                    bot.settings_manager.storage[item][
-                        "serverlist_message_id"
-                    ] = message.id
-            except Exception as e:
-                # this SHOULD NOT happen, kept there as "last resort"
+
+            guilds.append(item)
+
+        results = await fan_out_serverlists(guilds, infobox)
+        updated = 0
+        for item, result in zip(guilds, results):
+            if result is True:
+                serverlist.edits[item] = (fingerprint, now)
+                updated += 1
+            elif isinstance(result, Exception):
                 log.error(
-                    "Got exception while trying to edit serverlist message on"
-                    f"{item}/{chan_id}: {e}"
+                    f"Unable to update serverlist on {item}: "
+                    f"{type(result).__name__}: {result}",
+                    exc_info=result,
                 )
-                continue
 
-            infobox = embeds.make_servers_embed(bot.api_fetcher.get_servers())
-            # Attempting to deal with issues caused by discord api being unavailable.
-            try:
-                await message.edit(content=None, embed=infobox)
-            except Exception as e:
-                log.warning(
-                    f"Unable to edit serverlist on {item}/{chan_id}: {e}"
-                )
-                continue
-            else:
-                log.info(
-                    f"Successfully updated serverlist on {channel.id}/{message.id}"
-                )
+        duration = monotonic() - now
+        metrics.SERVERLIST_PASSES.observe(duration)
+        metrics.SERVERLIST_GUILDS.inc(updated, result="updated")
+        metrics.SERVERLIST_GUILDS.inc(skipped, result="skipped")
+        metrics.SERVERLIST_GUILDS.inc(len(guilds) - updated, result="failed")
+        log.info(
+            f"Serverlist update pass took {duration:.2f} seconds: {updated} "
+            f"updated, {skipped} skipped, {len(guilds) - updated} failed"
+        )
+        if duration > bot.api_fetcher.autoupdate_time:
+            log.warning(
+                "Serverlist update pass took longer than autoupdate time "
+                f"({bot.api_fetcher.autoupdate_time} seconds)"
+            )
+
+    @bot.before_invoke
+    async def before_command(ctx):
+        """Remember time command has been started at, for metrics"""
+        ctx.started = monotonic()
+
+    @bot.after_invoke
+    async def after_command(ctx):
+        """Record duration of finished command"""
+        started = getattr(ctx, "started", None)
+        if started is None:
+            return
+        metrics.COMMANDS.observe(
+            monotonic() - started,
+            command=ctx.command.qualified_name,
+            kind="prefix",
+            outcome="failure" if ctx.command_failed else "success",
+        )
 
     @bot.event
     async def on_ready():
         """Inform about bot going online and start autoupdating routine."""
 
-        log.info(f"Running {bot.name} as {bot.user}!")
-        log.debug("Launching stats autoupdater")
-        update_everything.start()
+        log.info(
+            f"Running {bot.name} as {bot.user} on shards "
+            f"{list(bot.shards)} of {bot.shard_count}!"
+        )
+        # on_ready may be triggered again, after reconnecting
+        if not update_everything.is_running():
+            log.debug("Launching stats autoupdater")
+            update_everything.start()
 
     @tasks.loop(seconds=bot.api_fetcher.autoupdate_time)
     async def update_everything():
@@ -221,6 +644,16 @@ def make_bot(
         log.debug("Updating bot's status")
         await update_status()
 
+        # Following interval of servers updates, in case its adaptive
+        if update_everything.seconds != bot.api_fetcher.autoupdate_time:
+            log.debug(
+                "Serverlists will be updated each "
+                f"{bot.api_fetcher.autoupdate_time} seconds"
+            )
+            update_everything.change_interval(
+                seconds=bot.api_fetcher.autoupdate_time
+            )
+
     @update_everything.before_loop
     async def before_updating():
         """Routine that ensure update_everything() only runs once bot is ready."""
@@ -258,7 +691,7 @@ def make_bot(
     async def get_servers(ctx):
         """Get base info about currently populated servers."""
 
-        infobox = embeds.make_servers_embed(bot.api_fetcher.get_servers())
+        infobox = embeds.make_servers_embed(await get_servers_data())
         await ctx.channel.send(
             content=None,
             embed=infobox,
@@ -281,21 +714,17 @@ def make_bot(
             return
 
         server_address = args[0]
-        # avoiding breakage on interactive uri
-        if server_address.startswith("<") and server_address.endswith(">"):
-            server_address = server_address[1 : (len(server_address) - 1)]
-        # support for kag:// uri
-        if server_address.startswith("kag://"):
-            server_address = server_address[6:]
-
-        data = embeds.make_server_embed(
-            bot.api_fetcher.get_server(*server_address.split(":"))
+        server_info = await bot.api_fetcher.get_server(
+            *parse_server_address(server_address),
+            fresh="--fresh" in args[1:],
         )
-        await ctx.channel.send(
+        data = embeds.make_server_embed(server_info)
+        message = await ctx.channel.send(
             content=None,
             file=data.attachment,
             embed=data.embed,
         )
+        remember_minimap_url(server_info, data, message)
         log.info(
             f"Responded {ctx.author} with server info of {server_address}."
         )
@@ -321,13 +750,11 @@ def make_bot(
             # Attempting to get ID of channel
             cid = await converter.convert(ctx, args[2])
             # ctx.guild.id must be str, coz json cant into ints in keys
-            bot.settings_manager.storage[str(ctx.guild.id)][
-                "serverlist_channel_id"
-            ] = cid.id
-            # resetting message id, in case its already been set in past
-            bot.settings_manager.storage[str(ctx.guild.id)][
-                "serverlist_message_id"
-            ] = None
+            bot.settings_manager.set_serverlist_channel(
+                str(ctx.guild.id), cid.id
+            )
+            serverlist.edits.pop(str(ctx.guild.id), None)
+            serverlist.messages.pop(str(ctx.guild.id), None)
             await ctx.channel.send(
                 f"Successfully set {cid} as channel for autoupdates"
             )
@@ -352,7 +779,7 @@ def make_bot(
 
         player = args[0]
         infobox = embeds.make_kagstats_embed(
-            bot.api_fetcher.get_kagstats(player)
+            await bot.api_fetcher.get_kagstats(player)
         )
         await ctx.channel.send(content=None, embed=infobox)
         log.info(
@@ -368,6 +795,8 @@ def make_bot(
         await ctx.channel.send(
             "This command requires leaderboard type. "
             f"For example: `{bot.command_prefix}leaderboard global kdr`\n"
+            "Optionally, you can also specify amount of top players to show. "
+            f"For example: `{bot.command_prefix}leaderboard global kdr 10`\n"
             "Available types are the following:\n"
             " - global kdr\n - global kills\n - global archer\n"
             " - global builder\n - global knight\n - monthly archer\n"
@@ -377,12 +806,34 @@ def make_bot(
             f"{ctx.author} has asked for leaderboard, but didnt specify type"
         )
 
-    async def get_leaderboard(ctx, scope: str):
-        """Get leaderboard of specified scope"""
-        infobox = embeds.make_leaderboard_embed(
-            bot.api_fetcher.get_leaderboard(scope)
+    async def get_leaderboard(ctx, scope: str, amount: str = None):
+        """Get leaderboard of specified scope with provided amount of players"""
+        if amount is not None:
+            amount = int(amount) if amount.isdigit() else 0
+            if amount < 1:
+                await ctx.channel.send(
+                    "Amount of players should be a positive number. For "
+                    f"example: `{bot.command_prefix}leaderboard global kdr 10`"
+                )
+                log.info(
+                    f"{ctx.author} has asked for leaderboard, but specified "
+                    "invalid amount of players"
+                )
+                return
+
+        pages = embeds.make_leaderboard_embeds(
+            await bot.api_fetcher.get_leaderboard(scope),
+            amount=amount,
         )
-        await ctx.channel.send(content=None, embed=infobox)
+        if len(pages) > 1:
+            view = LeaderboardView(pages)
+            view.message = await ctx.channel.send(
+                content=None,
+                embed=pages[0],
+                view=view,
+            )
+        else:
+            await ctx.channel.send(content=None, embed=pages[0])
         log.info(
             f"{ctx.author} has asked for {scope} leaderboard on "
             f"{ctx.guild.id}/{ctx.channel.id}. Responded"
@@ -390,19 +841,19 @@ def make_bot(
 
     @leaderboard_group.command(name="global")
     async def get_global_leaderboard(ctx, *args):
-        """Get top-3 players from global leaderboard of specified type"""
+        """Get top players from global leaderboard of specified type"""
 
         if args[0] in ("kills", "kdr"):
             prefix = args[0]
         else:
             prefix = f"global_{args[0]}"
 
-        await get_leaderboard(ctx, prefix)
+        await get_leaderboard(ctx, prefix, *args[1:2])
 
     @leaderboard_group.command(name="monthly")
     async def get_monthly_leaderboard(ctx, *args):
-        """Get top-3 players from monthly leaderboard of specified type"""
-        await get_leaderboard(ctx, f"monthly_{args[0]}")
+        """Get top players from monthly leaderboard of specified type"""
+        await get_leaderboard(ctx, f"monthly_{args[0]}", *args[1:2])
 
     @bot.command(name="help")
     async def get_help(ctx):
@@ -414,17 +865,20 @@ def make_bot(
             f"`{bot.command_prefix}server list` - will display list of active servers "
             "with their base info, aswell as their total population numbers\n"
             f"`{bot.command_prefix}server info *IP:port*` - will display detailed "
-            "info of selected server, including description and in-game minimap\n"
+            "info of selected server, including description and in-game minimap. "
+            "Add `--fresh` to skip info cached during last serverlist update\n"
             f"`{bot.command_prefix}kagstats *player*` - will display gameplay "
             "statistics of player with provided kagstats id or username\n"
-            f"`{bot.command_prefix}leaderboard *type*` - will display top-3 players "
-            "in this category of kagstats leaderboard. To get list of available parts - "
-            f"just type `{bot.command_prefix}leaderboard`, without specifying anything\n"
+            f"`{bot.command_prefix}leaderboard *type* *amount*` - will display top "
+            "players in this category of kagstats leaderboard (top-3, unless amount "
+            "is specified). To get list of available parts - just type "
+            f"`{bot.command_prefix}leaderboard`, without specifying anything\n"
             f"`{bot.command_prefix}set autoupdate channel #channel_id` - will set "
             f"passed channel to auto-fetch serverlist each {bot.api_fetcher.autoupdate_time} "
             "seconds. Keep in mind that you must be guild's admin to use it!\n"
             f"`{bot.command_prefix}help` - shows this message\n"
-            f"`{bot.command_prefix}about` - shows general bot's info"
+            f"`{bot.command_prefix}about` - shows general bot's info\n\n"
+            "Most of these are also available as slash commands"
         )
         log.info(
             f"{ctx.author.id} has asked for help on {ctx.guild.id}/{ctx.channel.id}. Responded"
@@ -436,4 +890,183 @@ def make_bot(
         await ctx.channel.send(content=None, embed=infobox)
         log.info(f"{ctx.author} has asked for info about this bot. Responded")
 
+    # Slash commands. These acknowledge interaction right away and respond once
+    # data is ready, thus users dont stare at nothing while its being fetched
+    async def autocomplete_server(
+        interaction: discord.Interaction,
+        current: str,
+    ) -> list:
+        """Suggest addresses of currently populated servers"""
+        data = bot.api_fetcher.kag_servers
+        if not data:
+            return []
+
+        current = current.lower()
+        choices = []
+        for server in data.servers:
+            title = f"{server.address} - {server.name}"
+            if current in title.lower():
+                choices.append(
+                    app_commands.Choice(name=title[:100], value=server.address)
+                )
+                if len(choices) >= AUTOCOMPLETE_MAX_CHOICES:
+                    break
+        return choices
+
+    async def autocomplete_leaderboard(
+        interaction: discord.Interaction,
+        current: str,
+    ) -> list:
+        """Suggest available leaderboard scopes"""
+        current = current.lower()
+        return [
+            app_commands.Choice(name=lb["description"], value=scope)
+            for scope, lb in fetcher.LEADERBOARD_SCOPES.items()
+            if current in scope or current in lb["description"].lower()
+        ][:AUTOCOMPLETE_MAX_CHOICES]
+
+    server_slash_group = app_commands.Group(
+        name="server",
+        description="Get info about kag servers",
+    )
+    bot.tree.add_command(server_slash_group)
+
+    @server_slash_group.command(
+        name="list",
+        description="Get base info about currently populated servers",
+    )
+    async def get_servers_slash(interaction: discord.Interaction):
+        await interaction.response.defer(thinking=True)
+        infobox = embeds.make_servers_embed(await get_servers_data())
+        await interaction.followup.send(embed=infobox)
+        log.info(f"{interaction.user} has asked for servers embed. Responded")
+
+    @server_slash_group.command(
+        name="info",
+        description="Get detailed info about specific kag server",
+    )
+    @app_commands.describe(
+        address="Server's address, in ip:port format",
+        fresh="Ask kag api for up to date info, instead of using latest one",
+    )
+    @app_commands.autocomplete(address=autocomplete_server)
+    async def get_server_slash(
+        interaction: discord.Interaction,
+        address: str,
+        fresh: bool = False,
+    ):
+        await interaction.response.defer(thinking=True)
+        server_info = await bot.api_fetcher.get_server(
+            *parse_server_address(address),
+            fresh=fresh,
+        )
+        data = embeds.make_server_embed(server_info)
+        kwargs = {}
+        if data.attachment is not None:
+            kwargs["file"] = data.attachment
+        message = await interaction.followup.send(
+            embed=data.embed,
+            wait=True,
+            **kwargs,
+        )
+        remember_minimap_url(server_info, data, message)
+        log.info(f"Responded {interaction.user} with server info of {address}.")
+
+    @bot.tree.command(
+        name="kagstats",
+        description="Get player's kagstats profile info",
+    )
+    @app_commands.describe(player="Player's username or kagstats id")
+    async def get_kagstats_slash(interaction: discord.Interaction, player: str):
+        await interaction.response.defer(thinking=True)
+        infobox = embeds.make_kagstats_embed(
+            await bot.api_fetcher.get_kagstats(player)
+        )
+        await interaction.followup.send(embed=infobox)
+        log.info(
+            f"{interaction.user} has asked for player info of {player} on "
+            f"{interaction.guild_id}/{interaction.channel_id}. Responded"
+        )
+
+    @bot.tree.command(
+        name="leaderboard",
+        description="Get top players of kagstats leaderboard",
+    )
+    @app_commands.describe(
+        scope="Type of leaderboard",
+        amount="Amount of top players to show. Default is "
+        f"{embeds.LEADERBOARD_DEFAULT_AMOUNT}",
+    )
+    @app_commands.autocomplete(scope=autocomplete_leaderboard)
+    async def get_leaderboard_slash(
+        interaction: discord.Interaction,
+        scope: str,
+        amount: app_commands.Range[int, 1, None] = None,
+    ):
+        if scope not in fetcher.LEADERBOARD_SCOPES:
+            await interaction.response.send_message(
+                f"There is no '{scope}' leaderboard. "
+                "Please pick one of suggested types",
+                ephemeral=True,
+            )
+            return
+
+        await interaction.response.defer(thinking=True)
+        pages = embeds.make_leaderboard_embeds(
+            await bot.api_fetcher.get_leaderboard(scope),
+            amount=amount,
+        )
+        if len(pages) > 1:
+            view = LeaderboardView(pages)
+            view.message = await interaction.followup.send(
+                embed=pages[0],
+                view=view,
+                wait=True,
+            )
+        else:
+            await interaction.followup.send(embed=pages[0])
+        log.info(
+            f"{interaction.user} has asked for {scope} leaderboard on "
+            f"{interaction.guild_id}/{interaction.channel_id}. Responded"
+        )
+
+    @bot.tree.command(
+        name="autoupdate",
+        description="Set channel to autoupdate serverlist in",
+    )
+    @app_commands.describe(channel="Channel to post serverlist into")
+    @app_commands.guild_only()
+    @app_commands.default_permissions(administrator=True)
+    async def configure_slash(
+        interaction: discord.Interaction,
+        channel: discord.TextChannel,
+    ):
+        # Default permissions can be overriden by guild, thus double-checking
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message(
+                "You must have admin rights on this guild to do that",
+                ephemeral=True,
+            )
+            return
+
+        guild_id = str(interaction.guild_id)
+        bot.settings_manager.set_serverlist_channel(guild_id, channel.id)
+        serverlist.edits.pop(guild_id, None)
+        serverlist.messages.pop(guild_id, None)
+        await interaction.response.send_message(
+            f"Successfully set {channel.mention} as channel for autoupdates"
+        )
+        log.info(
+            f"{interaction.user.id} has set {channel.id} as channel for "
+            f"autoupdates on {guild_id}/{interaction.channel_id}"
+        )
+
+    @bot.tree.command(name="about", description="Get general info about bot")
+    async def get_bot_description_slash(interaction: discord.Interaction):
+        infobox = embeds.make_about_embed(name=bot.name)
+        await interaction.response.send_message(embed=infobox)
+        log.info(
+            f"{interaction.user} has asked for info about this bot. Responded"
+        )
+
     return bot
@@ -17,12 +17,22 @@
 # This module contains functions related to processing embeds
 
 from notashark import parts
+import json
 import logging
 from discord import utils, Embed, File
 from discord.utils import utcnow
 
 log = logging.getLogger(__name__)
 
+# Max total amount of characters, allowed by discord in a single embed
+EMBED_MAX_LENGTH = 6000
+# Amount of characters, reserved for page numbers in footer
+EMBED_FOOTER_RESERVE = 32
+# Amount of leaderboard's top players to show by default, like kagstats webui
+LEADERBOARD_DEFAULT_AMOUNT = 3
+# Max amount of players on single page of leaderboard
+LEADERBOARD_PAGE_SIZE = 10
+
 
 def sanitize(data: str) -> str:
     """Sanitize provided data to dont include special symbols"""
@@ -30,18 +40,32 @@ def sanitize(data: str) -> str:
     return str(utils.escape_mentions(utils.escape_markdown(data)))
 
 
+def get_embed_fingerprint(embed: Embed) -> int:
+    """Get fingerprint of embed's content, excluding its timestamp"""
+
+    data = embed.to_dict()
+    data.pop("timestamp", None)
+    return hash(json.dumps(data, sort_keys=True))
+
+
 def make_server_embed(
     data: parts.KagServerInfo,
 ) -> parts.EmbedStorage:
     """Build single server embed out of provided data"""
 
-    # This is a nasty workaround to fix the discord's "clever" caching issue
-    # Basically - if filename stays the same, sometimes discord decides to show
-    # the older image instead of never. Which cause minimap to never update
-    # This will crash if minimap doesnt exist #TODO
     timestamp = utcnow()
-    filename = f"{timestamp.timestamp()}_minimap.png"
-    minimap = File(data.minimap, filename=filename)
+    if data.minimap_url:
+        # Reusing previously uploaded minimap, no need to attach it again
+        minimap = None
+        minimap_url = data.minimap_url
+    else:
+        # This is a nasty workaround to fix the discord's "clever" caching issue
+        # Basically - if filename stays the same, sometimes discord decides to
+        # show the older image instead of never. Which cause minimap to never
+        # update. This will crash if minimap doesnt exist #TODO
+        filename = f"{timestamp.timestamp()}_minimap.png"
+        minimap = File(data.minimap, filename=filename)
+        minimap_url = f"attachment://{filename}"
 
     embed = Embed(timestamp=timestamp)
     embed.colour = 0x3498DB
@@ -87,13 +111,15 @@ def make_server_embed(
         inline=False,
     )
 
-    embed.set_image(url=f"attachment://{filename}")
+    embed.set_image(url=minimap_url)
 
     return parts.EmbedStorage(embed, minimap)
 
 
-def make_servers_embed(data: parts.KagServers) -> Embed:
-    """Build embed with summary about all populated kag servers"""
+def make_servers_embed(data: parts.KagServers, age: int = None) -> Embed:
+    """Build embed with summary about all populated kag servers.
+    If age (in minutes) is specified - data is marked as outdated
+    """
 
     embed = Embed(timestamp=utcnow())
     embed.colour = 0x3498DB
@@ -102,6 +128,10 @@ def make_servers_embed(data: parts.KagServers) -> Embed:
         f"**Current Amount of Players:** {data.players_amount}\n"
         f"**Currently Active Servers:** {len(data.servers)}\n"
     )
+    if age is not None:
+        embed_overview += (
+            f"**As Of:** {age} minutes ago (KAG API is unavailable)\n"
+        )
 
     embed.add_field(
         name="Overview:",
@@ -223,13 +253,16 @@ def make_kagstats_embed(data: parts.KagstatsProfile) -> Embed:
     return embed
 
 
-def make_leaderboard_embed(data: parts.Leaderboard) -> Embed:
-    """Build leaderboard embed with provided leaderboard content"""
+def make_leaderboard_embed(
+    data: parts.Leaderboard,
+    players: list = None,
+) -> Embed:
+    """Build leaderboard embed with provided leaderboard content.
+    If players arent specified, top-3 of leaderboard will be shown
+    """
 
-    players = []
-    for item, position in zip(data.players, ("First", "Second", "Third")):
-        item.position = position
-        players.append(item)
+    if players is None:
+        players = data.players[:LEADERBOARD_DEFAULT_AMOUNT]
 
     embed = Embed(timestamp=utcnow())
     embed.colour = 0x3498DB
@@ -245,7 +278,7 @@ def make_leaderboard_embed(data: parts.Leaderboard) -> Embed:
 
     for player in players:
         embed.add_field(
-            name=f"{player.position}:",
+            name=f"#{player.position}:",
             value=(
                 f"**Name:** {player.clantag[:256]} "
                 f"{player.nickname[:256]}\n"
@@ -260,6 +293,40 @@ def make_leaderboard_embed(data: parts.Leaderboard) -> Embed:
     return embed
 
 
+def make_leaderboard_embeds(
+    data: parts.Leaderboard,
+    amount: int = None,
+) -> list:
+    """Build list of leaderboard embeds with provided amount of top players,
+    split into pages that fit into discord's limits of embed size
+    """
+
+    players = data.players[: (amount or LEADERBOARD_DEFAULT_AMOUNT)]
+
+    # Splitting players into pages, without overflowing any of them
+    pages = []
+    page = []
+    for player in players:
+        if page and (
+            len(page) >= LEADERBOARD_PAGE_SIZE
+            or len(make_leaderboard_embed(data, page + [player]))
+            > (EMBED_MAX_LENGTH - EMBED_FOOTER_RESERVE)
+        ):
+            pages.append(page)
+            page = []
+        page.append(player)
+    pages.append(page)
+
+    embeds = []
+    for number, page in enumerate(pages, start=1):
+        embed = make_leaderboard_embed(data, page)
+        if len(pages) > 1:
+            embed.set_footer(text=f"Page {number}/{len(pages)}")
+        embeds.append(embed)
+
+    return embeds
+
+
 def make_about_embed(name: str = "notashark", prefix: str = "!") -> Embed:
     """Build embed with general info about this bot"""
 
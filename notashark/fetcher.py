@@ -16,74 +16,151 @@
 
 # This module contains everything related to fetching and processing data from api
 
-from notashark import parts
+from notashark import images, metrics, parts
+from notashark.cache import BytesCache, TTLCache
 from notashark.embeds import sanitize
-import requests
+import aiohttp
+import asyncio
 import json
 from pykagapi import kag, kagstats
-from threading import Lock
 from re import sub
-from time import sleep
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import replace as copy_dataclass
+from os import replace
+from os.path import join
+from random import uniform
+from time import monotonic, time
 import logging
 
 log = logging.getLogger(__name__)
 
 DEFAULT_AUTOUPDATE_TIME = 30
+# Default bounds of servers update interval, if its adaptive
+DEFAULT_MIN_AUTOUPDATE_TIME = 10
+DEFAULT_MAX_AUTOUPDATE_TIME = 120
+DEFAULT_REQUEST_TIMEOUT = 30
+DEFAULT_CONNECTIONS_PER_HOST = 10
+DEFAULT_CONNECTIONS_LIMIT = 100
+DEFAULT_COUNTRIES_FILE = join(".", "countries.jsonl")
+# Servers dont tend to move between countries, thus a week should be fine
+DEFAULT_COUNTRIES_TTL = 7 * 24 * 60 * 60
+DEFAULT_LEADERBOARDS_UPDATE_TIME = 600
+DEFAULT_MINIMAPS_CACHE_BYTES = 32 * 1024 * 1024
+# Minimaps reflect changes to terrain, thus they shouldnt be cached for long
+DEFAULT_MINIMAPS_CACHE_TTL = 60
+# Urls of uploaded attachments expire after a while, keeping it well below that
+DEFAULT_MINIMAP_URLS_TTL = 60 * 60
+# Amount of threads used to process minimaps
+DEFAULT_IMAGE_WORKERS = 2
+DEFAULT_PROFILES_CACHE_SIZE = 1024
+DEFAULT_PROFILES_CACHE_TTL = 300
+# Max amount of seconds between retries of failed servers update
+DEFAULT_MAX_BACKOFF_TIME = 300
+# Amount of failed requests in a row, after which upstream is considered down
+DEFAULT_BREAKER_THRESHOLD = 5
+# Amount of seconds, during which requests to upstream that is down are skipped
+DEFAULT_BREAKER_RESET_TIME = 60
+# Weight of the latest update in averages of PollScheduler
+SCHEDULER_SMOOTHING = 0.2
+# Servers update interval is never less than that many latencies of kag api
+SCHEDULER_LATENCY_FACTOR = 10
+# How much servers update interval grows, if all updates fail
+SCHEDULER_ERROR_PENALTY = 3
+
+USER_AGENT = "notashark"
+
+# Reusing urls from pykagapi, to keep them in one place
+KAG_SERVERS_URL = kag.servers.API_URL
+KAG_SERVER_URL = kag.server.API_URL.rstrip("/")
+KAGSTATS_PLAYERS_URL = kagstats.player.API_URL
+KAGSTATS_LEADERBOARD_URL = kagstats.leaderboard.API_URL
+GEOJS_URL = "https://get.geojs.io/v1/ip/country"
+# Max amount of ips per single geojs.io request, to keep urls reasonably short
+GEOJS_BATCH_SIZE = 50
+# Geo lookups should never delay the serverlist for long, thus separate timeout
+DEFAULT_GEO_TIMEOUT = 5
+
+# Used in place of country of servers, whose location couldnt be resolved
+UNKNOWN_COUNTRY_PREFIX = "white"
+UNKNOWN_COUNTRY_NAME = "Unknown"
+
+# Fields of raw server info, used by AsyncApiFetcher.clean_server_info()
+SERVER_INFO_FIELDS = (
+    "IPv4Address",
+    "port",
+    "name",
+    "description",
+    "gameMode",
+    "usingMods",
+    "playerList",
+    "maxPlayers",
+    "spectatorPlayers",
+    "password",
+    "mapW",
+    "mapH",
+)
+
+# Same filters as used by kag.servers.active()
+ACTIVE_SERVERS_FILTERS = [
+    {"field": "current", "op": "eq", "value": True},
+    {"field": "currentPlayers", "op": "ge", "value": 1},
+]
 
 LEADERBOARD_URL = "https://kagstats.com/#/leaderboards"
 LEADERBOARD_SCOPES = {
     "kdr": {
-        "get_leaderboard": kagstats.leaderboard.global_kdr,
+        "path": "",
         "description": "All Time KDR",
         "url": "Hidden",
         "kills_slug": "totalKills",
         "deaths_slug": "totalDeaths",
     },
     "kills": {
-        "get_leaderboard": kagstats.leaderboard.global_kills,
+        "path": "/kills",
         "description": "All Time Kills",
         "url": "Hidden",
         "kills_slug": "totalKills",
         "deaths_slug": "totalDeaths",
     },
     "global_archer": {
-        "get_leaderboard": kagstats.leaderboard.global_archer,
+        "path": "/archer",
         "description": "All Time Archer",
         "url": LEADERBOARD_URL + "/Archer",
         "kills_slug": "archerKills",
         "deaths_slug": "archerDeaths",
     },
     "monthly_archer": {
-        "get_leaderboard": kagstats.leaderboard.monthly_archer,
+        "path": "/monthly/archer",
         "description": "Monthly Archer",
         "url": LEADERBOARD_URL + "/MonthlyArcher",
         "kills_slug": "archerKills",
         "deaths_slug": "archerDeaths",
     },
     "global_builder": {
-        "get_leaderboard": kagstats.leaderboard.global_builder,
+        "path": "/builder",
         "description": "All Time Builder",
         "url": LEADERBOARD_URL + "/Builder",
         "kills_slug": "builderKills",
         "deaths_slug": "builderDeaths",
     },
     "monthly_builder": {
-        "get_leaderboard": kagstats.leaderboard.monthly_builder,
+        "path": "/monthly/builder",
         "description": "Monthly Builder",
         "url": LEADERBOARD_URL + "/MonthlyBuilder",
         "kills_slug": "builderKills",
         "deaths_slug": "builderDeaths",
     },
     "global_knight": {
-        "get_leaderboard": kagstats.leaderboard.global_knight,
+        "path": "/knight",
         "description": "All Time Knight",
         "url": LEADERBOARD_URL + "/Knight",
         "kills_slug": "knightKills",
         "deaths_slug": "knightDeaths",
     },
     "monthly_knight": {
-        "get_leaderboard": kagstats.leaderboard.monthly_knight,
+        "path": "/monthly/knight",
         "description": "Monthly Knight",
         "url": LEADERBOARD_URL + "/MonthlyKnight",
         "kills_slug": "knightKills",
@@ -133,38 +210,599 @@ HITTER_NAMES = (
 )
 
 
-class ApiFetcher:
-    """Fetches various data from KAG APIs"""
+def get_kdr(kills: int, deaths: int) -> str:
+    """Get kills/deaths ratio, formatted like x.xx to match kagstats ui.
+    Using formatter, coz round() would trim multiple zeros to one.
+    Players without deaths get their kills as kdr, like kag itself does
+    """
+    return "%.2f" % (kills / deaths if deaths else kills)
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of requests to upstream api that is currently down"""
+
+
+def is_upstream_failure(e: Exception) -> bool:
+    """Check if provided exception means that upstream api is in trouble.
+    Client errors like 404 on lookup of missing player dont count
+    """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    return True
+
+
+class CircuitBreaker:
+    """Stops requests to upstream api after it failed multiple times in a row.
+    Once reset time passes, requests are let through again, but the very
+    first failure stops them for another reset time
+    """
+
+    def __init__(
+        self,
+        name: str,
+        threshold: int = None,
+        reset_time: int = None,
+    ):
+        self.name = name
+        self.threshold = threshold or DEFAULT_BREAKER_THRESHOLD
+        self.reset_time = reset_time or DEFAULT_BREAKER_RESET_TIME
+        self.failures = 0
+        # Time upstream has been considered down at. None if its up
+        self.opened_at = None
+
+    def is_open(self) -> bool:
+        """Check if requests to upstream should be skipped at the moment"""
+        return (
+            self.opened_at is not None
+            and monotonic() - self.opened_at < self.reset_time
+        )
+
+    def check(self):
+        """Raise UpstreamUnavailable if requests should be skipped"""
+        if self.is_open():
+            retry_in = self.reset_time - (monotonic() - self.opened_at)
+            raise UpstreamUnavailable(
+                f"{self.name} api is unavailable, retrying in {retry_in:.0f}s"
+            )
+
+    def record_success(self):
+        if self.opened_at is not None:
+            log.info(f"{self.name} api is available again")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        # After reset time passed, single failure is enough to open again
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if not self.is_open():
+                log.warning(
+                    f"{self.name} api has failed {self.failures} times in a "
+                    f"row, skipping requests for {self.reset_time} seconds"
+                )
+            self.opened_at = monotonic()
 
-    def __init__(self, autoupdate_time: int = None):
-        self.autoupdate_time = autoupdate_time or DEFAULT_AUTOUPDATE_TIME
-        self.countries_locker = Lock()
-        self.servers_locker = Lock()
+
+class PollScheduler:
+    """Picks interval between servers updates within provided bounds.
+    Polls more often while servers change on most of updates and less often
+    while they dont. Slow or failing upstream makes interval longer
+    """
+
+    def __init__(
+        self,
+        min_time: float = None,
+        max_time: float = None,
+        initial_time: float = None,
+    ):
+        self.min_time = min_time or DEFAULT_MIN_AUTOUPDATE_TIME
+        self.max_time = max(
+            max_time or DEFAULT_MAX_AUTOUPDATE_TIME, self.min_time
+        )
+        self.interval = min(
+            max(initial_time or DEFAULT_AUTOUPDATE_TIME, self.min_time),
+            self.max_time,
+        )
+        # Moving averages of updates. Rate of changes starts from value that
+        # corresponds to initial interval
+        if self.max_time > self.min_time:
+            self.change_rate = (self.max_time - self.interval) / (
+                self.max_time - self.min_time
+            )
+        else:
+            self.change_rate = 1.0
+        self.error_rate = 0.0
+        self.latency = None
+
+    def record(
+        self,
+        changed: bool,
+        latency: float,
+        failed: bool = False,
+    ) -> float:
+        """Record result of servers update and get interval till the next one"""
+        self.error_rate += SCHEDULER_SMOOTHING * (failed - self.error_rate)
+        if not failed:
+            self.change_rate += SCHEDULER_SMOOTHING * (
+                changed - self.change_rate
+            )
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += SCHEDULER_SMOOTHING * (latency - self.latency)
+
+        interval = self.max_time - (
+            (self.max_time - self.min_time) * self.change_rate
+        )
+        interval *= 1 + SCHEDULER_ERROR_PENALTY * self.error_rate
+        if self.latency is not None:
+            interval = max(interval, self.latency * SCHEDULER_LATENCY_FACTOR)
+        self.interval = min(max(interval, self.min_time), self.max_time)
+
+        return self.interval
+
+
+class CountryCache:
+    """Countries of known server ips, indexed by ip and persisted on disk.
+    Storage file is in json lines format, with one geojs.io entry per line
+    """
+
+    def __init__(self, cache_file: str = None, ttl: int = None):
+        self.cache_file = cache_file or DEFAULT_COUNTRIES_FILE
+        self.ttl = ttl or DEFAULT_COUNTRIES_TTL
+        self.storage = {}
+        self.load()
+
+    def is_expired(self, entry: dict) -> bool:
+        """Check if provided entry has outlived self.ttl"""
+        return (time() - entry.get("timestamp", 0)) > self.ttl
+
+    def load(self):
+        """Load non-expired entries from self.cache_file into self.storage"""
+        lines_amount = 0
+        try:
+            with open(self.cache_file, "r") as f:
+                for line in f:
+                    lines_amount += 1
+                    try:
+                        entry = json.loads(line)
+                        ip = entry["ip"]
+                    except Exception:
+                        log.warning(f"Skipping malformed country entry: {line}")
+                        continue
+                    # Later entries override older ones for the same ip
+                    if self.is_expired(entry):
+                        self.storage.pop(ip, None)
+                    else:
+                        self.storage[ip] = entry
+        except FileNotFoundError:
+            log.debug(f"{self.cache_file} doesnt exist, starting from scratch")
+            return
+        except Exception as e:
+            log.error(f"Unable to load countries from {self.cache_file}: {e}")
+            return
+
+        log.info(f"Loaded {len(self.storage)} countries from {self.cache_file}")
+        # Getting rid of expired and duplicate entries, if there are any
+        if lines_amount > len(self.storage):
+            self.compact()
+
+    def compact(self):
+        """Rewrite self.cache_file to only contain entries from self.storage"""
+        tmp_file = f"{self.cache_file}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                for entry in self.storage.values():
+                    f.write(json.dumps(entry) + "\n")
+            replace(tmp_file, self.cache_file)
+        except Exception as e:
+            log.error(f"Unable to compact {self.cache_file}: {e}")
+        else:
+            log.debug(f"Successfully compacted {self.cache_file}")
+
+    def get(self, ip: str) -> dict:
+        """Get country entry of provided ip. Returns None if its unknown"""
+        entry = self.storage.get(ip)
+        if entry is not None and self.is_expired(entry):
+            del self.storage[ip]
+            return None
+        return entry
+
+    def update(self, countries: list):
+        """Add provided geojs.io country entries to storage and cache file"""
+        lines = []
+        for country in countries:
+            entry = dict(country, timestamp=time())
+            self.storage[entry["ip"]] = entry
+            lines.append(json.dumps(entry) + "\n")
+
+        try:
+            with open(self.cache_file, "a") as f:
+                f.writelines(lines)
+        except Exception as e:
+            log.error(f"Unable to save countries to {self.cache_file}: {e}")
+
+
+class ServersSnapshot:
+    """Cleaned up info of servers from last refresh, keyed by ip:port.
+    Used to avoid cleaning up servers whose data didnt change since then
+    """
+
+    def __init__(self):
+        # address: (fingerprint, parts.KagServerInfo)
+        self.entries = {}
+        self.revision = 0
+
+    @staticmethod
+    def get_fingerprint(info: dict, country: dict = None) -> int:
+        """Get fingerprint of fields, used to build parts.KagServerInfo"""
+        return hash(
+            json.dumps(
+                [info.get(field) for field in SERVER_INFO_FIELDS],
+                default=str,
+            )
+            # Country is included, since it may get resolved later than server
+            + str(country and country["country"])
+        )
+
+    def update(
+        self,
+        raw_data: list,
+        clean,
+        countries: CountryCache,
+        commit: bool = True,
+    ) -> tuple:
+        """Update snapshot with provided raw servers data.
+        Servers are cleaned up with provided function, but only if they have
+        been changed since the last update. If commit is False, snapshot
+        itself is left intact, thus diff of the next update isnt affected.
+        Returns list of cleaned up servers and parts.ServersDiff
+        """
+        entries = {}
+        added = []
+        changed = []
+        for info in raw_data:
+            address = f"{info['IPv4Address']}:{info['port']}"
+            fingerprint = self.get_fingerprint(
+                info, countries.get(info["IPv4Address"])
+            )
+            old = self.entries.get(address)
+            if old is None:
+                added.append(address)
+            elif old[0] != fingerprint:
+                changed.append(address)
+            else:
+                entries[address] = old
+                continue
+
+            entries[address] = (fingerprint, clean(info))
+
+        removed = [x for x in self.entries if x not in entries]
+        diff = parts.ServersDiff(added=added, removed=removed, changed=changed)
+        if commit:
+            self.entries = entries
+            if diff.has_changes:
+                self.revision += 1
+            log.debug(f"Servers snapshot has been updated: {diff}")
+
+        return [x[1] for x in entries.values()], diff
+
+
+class AsyncApiFetcher:
+    """Fetches various data from KAG APIs without blocking the event loop"""
+
+    def __init__(
+        self,
+        autoupdate_time: int = None,
+        request_timeout: int = None,
+        connections_per_host: int = None,
+        country_cache: CountryCache = None,
+        geo_timeout: int = None,
+        profiles_cache_ttl: int = None,
+        leaderboards_update_time: int = None,
+        minimaps_cache_ttl: int = None,
+        optimize_minimaps: bool = False,
+        minimap_max_size: tuple = None,
+        scheduler: PollScheduler = None,
+    ):
+        # If scheduler is provided - interval between servers updates is
+        # picked by it, and self.autoupdate_time reflects its current value
+        self.scheduler = scheduler
+        self.autoupdate_time = (
+            scheduler.interval
+            if scheduler
+            else (autoupdate_time or DEFAULT_AUTOUPDATE_TIME)
+        )
+        self.request_timeout = request_timeout or DEFAULT_REQUEST_TIMEOUT
+        self.connections_per_host = (
+            connections_per_host or DEFAULT_CONNECTIONS_PER_HOST
+        )
+        self.leaderboards_update_time = (
+            leaderboards_update_time or DEFAULT_LEADERBOARDS_UPDATE_TIME
+        )
+        # These can only be created from within running event loop,
+        # thus they are initialized in self.start()
+        self.session = None
+        self.autoupdate_task = None
+        self.leaderboards_task = None
+        # scope: parts.Leaderboard, prebuilt by self.leaderboards_routine()
+        self.leaderboards = {}
+        # url: headers used to validate cached content (ETag and such)
+        self.validators = {}
         self.kag_servers = None
-        self.known_server_countries = []
+        self.countries = country_cache or CountryCache()
+        self.snapshot = ServersSnapshot()
+        # (address, map_id): minimap
+        self.minimaps = BytesCache(
+            max_bytes=DEFAULT_MINIMAPS_CACHE_BYTES,
+            ttl=minimaps_cache_ttl or DEFAULT_MINIMAPS_CACHE_TTL,
+        )
+        if optimize_minimaps and not images.is_available():
+            log.warning("Unable to optimize minimaps: Pillow is not installed")
+            optimize_minimaps = False
+        self.optimize_minimaps = optimize_minimaps
+        # (max width, max height) of optimized minimaps, either may be None
+        self.minimap_max_size = minimap_max_size or (None, None)
+        # Minimaps are processed in separate threads, to not block event loop
+        self.images_executor = None
+        # (address, map_id): url of minimap, uploaded to discord. Reused url
+        # shows the same minimap, thus it shouldnt outlive cached minimap
+        self.minimap_urls = TTLCache(
+            ttl=min(self.minimaps.ttl, DEFAULT_MINIMAP_URLS_TTL)
+        )
+        self.profiles = TTLCache(
+            max_size=DEFAULT_PROFILES_CACHE_SIZE,
+            ttl=profiles_cache_ttl or DEFAULT_PROFILES_CACHE_TTL,
+        )
+        self.geo_timeout = geo_timeout or DEFAULT_GEO_TIMEOUT
+        metrics.register_cache("profiles", self.profiles)
+        metrics.register_cache("minimaps", self.minimaps)
+        metrics.register_cache("minimap_urls", self.minimap_urls)
+        # Callbacks, notified about updates of self.kag_servers and
+        # self.leaderboards. See self.subscribe()
+        self.subscribers = []
+        # upstream: CircuitBreaker. See self.get_upstream()
+        self.breakers = {
+            name: CircuitBreaker(name) for name in ("kag", "kagstats", "geojs")
+        }
+
+    def subscribe(self, callback):
+        """Call provided callback with ("servers", parts.KagServers),
+        ("leaderboard", scope, parts.Leaderboard) or ("autoupdate_time", int)
+        each time these get updated
+        """
+        self.subscribers.append(callback)
+
+    def notify(self, *update):
+        """Pass provided update to all subscribers"""
+        for callback in self.subscribers:
+            try:
+                callback(*update)
+            except Exception as e:
+                log.warning(f"Subscriber {callback} has failed: {e}")
+
+    async def start(self):
+        """Open shared http session and launch self.autoupdate_routine() and
+        self.leaderboards_routine() as tasks.
+        Must be called from within running event loop
+        """
+        if self.session is None or self.session.closed:
+            log.debug("Opening http session")
+            self.session = aiohttp.ClientSession(
+                # Single pool of keep-alive connections, shared by all requests
+                connector=aiohttp.TCPConnector(
+                    limit=DEFAULT_CONNECTIONS_LIMIT,
+                    limit_per_host=self.connections_per_host,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                headers={"user-agent": USER_AGENT},
+                raise_for_status=True,
+            )
+
+        if self.autoupdate_task is None or self.autoupdate_task.done():
+            log.debug("Launching servers autoupdater")
+            self.autoupdate_task = asyncio.create_task(
+                self.autoupdate_routine()
+            )
+
+        if self.leaderboards_task is None or self.leaderboards_task.done():
+            log.debug("Launching leaderboards autoupdater")
+            self.leaderboards_task = asyncio.create_task(
+                self.leaderboards_routine()
+            )
+
+    async def close(self):
+        """Stop background routines and close http session"""
+        for task in (self.autoupdate_task, self.leaderboards_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                log.warning(f"Background routine has failed: {e}")
+        self.autoupdate_task = None
+        self.leaderboards_task = None
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+        if self.images_executor is not None:
+            self.images_executor.shutdown(wait=False)
+            self.images_executor = None
 
-    def get_country(self, ip: str) -> dict:
-        """Get country of provided ip. Format is based on geojs.io data"""
-        response = requests.get(
-            url=f"https://get.geojs.io/v1/ip/country/{ip}.json",
-            timeout=30,
+        log.debug("Successfully closed api fetcher")
+
+    def get_upstream(self, url: str) -> str:
+        """Get name of upstream api, provided url belongs to"""
+        if url.startswith(GEOJS_URL):
+            return "geojs"
+        if url.startswith((KAGSTATS_PLAYERS_URL, KAGSTATS_LEADERBOARD_URL)):
+            return "kagstats"
+        return "kag"
+
+    @asynccontextmanager
+    async def guard(self, url: str):
+        """Guard request to provided url with circuit breaker of its upstream.
+        Raises UpstreamUnavailable instead of making request, if its down
+        """
+        upstream = self.get_upstream(url)
+        breaker = self.breakers[upstream]
+        try:
+            breaker.check()
+        except UpstreamUnavailable:
+            metrics.UPSTREAM_REQUESTS.observe(
+                0, upstream=upstream, outcome="unavailable"
+            )
+            raise
+
+        # Stays None if request gets cancelled, coz it tells nothing about
+        # upstream
+        outcome = None
+        started = monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_upstream_failure(e):
+                breaker.record_failure()
+                outcome = "failure"
+            else:
+                breaker.record_success()
+                outcome = "client_error"
+            raise
+        else:
+            breaker.record_success()
+            outcome = "success"
+        finally:
+            if outcome is not None:
+                metrics.UPSTREAM_REQUESTS.observe(
+                    monotonic() - started, upstream=upstream, outcome=outcome
+                )
+
+    async def get_json(self, url: str, **kwargs):
+        """Get json data from provided url via shared http session"""
+        log.debug(f"Fetching {url}")
+        async with self.guard(url), self.session.get(url, **kwargs) as response:
+            # Some of apis dont set content type correctly, thus None
+            return await response.json(content_type=None)
+
+    async def get_json_if_modified(self, url: str, **kwargs):
+        """Get json data from provided url, if it has changed since last time.
+        Uses ETag and Last-Modified headers of previous response, where
+        available. Returns None if content didnt change
+        """
+        headers = {}
+        validators = self.validators.get(url, {})
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+
+        log.debug(f"Fetching {url}")
+        async with self.guard(url), self.session.get(
+            url, headers=headers, **kwargs
+        ) as response:
+            if response.status == 304:
+                log.debug(f"{url} didnt change since last time")
+                return None
+
+            data = await response.json(content_type=None)
+            self.validators[url] = {
+                key: response.headers[key]
+                for key in ("ETag", "Last-Modified")
+                if key in response.headers
+            }
+            return data
+
+    async def get_bytes(self, url: str, **kwargs) -> bytes:
+        """Get binary data from provided url via shared http session"""
+        log.debug(f"Fetching {url}")
+        async with self.guard(url), self.session.get(url, **kwargs) as response:
+            return await response.read()
+
+    async def get_countries(self, ips: list) -> list:
+        """Get countries of provided ips. Format is based on geojs.io data"""
+        data = await self.get_json(
+            f"{GEOJS_URL}.json",
+            params={"ip": ",".join(ips)},
+            timeout=aiohttp.ClientTimeout(total=self.geo_timeout),
         )
-        return json.loads(response.text)
+        # geojs.io returns plain dict instead of list if there was just one ip
+        return data if isinstance(data, list) else [data]
 
-    def get_servers(self) -> parts.KagServers:
-        """Get info about active kag servers"""
+    async def resolve_countries(self, ips: list):
+        """Resolve countries of ips that arent in self.countries yet.
+        Lookups are done in batches and bound by self.geo_timeout, failed ones
+        will be retried on next call
+        """
+        unknown = [ip for ip in set(ips) if not self.countries.get(ip)]
+        if not unknown:
+            return
+
+        log.debug(f"Resolving countries of {len(unknown)} unknown ips")
+        chunks = [
+            unknown[i : i + GEOJS_BATCH_SIZE]
+            for i in range(0, len(unknown), GEOJS_BATCH_SIZE)
+        ]
+        # Batches are requested concurrently, each bound by self.geo_timeout.
+        # Not wrapping them into another timeout, coz cancelled requests dont
+        # count towards failures of circuit breaker
+        results = await asyncio.gather(
+            *(self.get_countries(chunk) for chunk in chunks),
+            return_exceptions=True,
+        )
+
+        countries = []
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                if isinstance(result, asyncio.TimeoutError):
+                    result = "timed out"
+                log.warning(f"Unable to resolve countries of {chunk}: {result}")
+                continue
+            countries.extend(
+                item
+                for item in result
+                if item.get("country") and item.get("ip")
+            )
+
+        if countries:
+            self.countries.update(countries)
+            log.debug(f"Added {len(countries)} countries into storage")
+
+    @metrics.FETCHER_CALLS.timed(method="get_servers")
+    async def get_servers(
+        self, update_snapshot: bool = False
+    ) -> parts.KagServers:
+        """Get info about active kag servers.
+        Only self.autoupdate_routine() should update self.snapshot, otherwise
+        direct requests would consume diffs of autoupdates
+        """
         log.debug("Fetching servers from kag api")
-        raw_data = kag.servers.active()
+        raw_data = (
+            await self.get_json(
+                KAG_SERVERS_URL,
+                params={"filters": json.dumps(ACTIVE_SERVERS_FILTERS)},
+            )
+        )["serverList"]
 
         # Calculating amount of players
         players_amount = 0
         for x in raw_data:
             players_amount += len(x["playerList"])
 
-        # Removing unnecessary info from server entries, fixing format
-        servers = []
-        for server in raw_data:
-            servers.append(self.clean_server_info(server))
+        await self.resolve_countries([x["IPv4Address"] for x in raw_data])
+
+        # Removing unnecessary info from server entries, fixing format.
+        # Servers that didnt change since last time are reused as they are
+        servers, diff = self.snapshot.update(
+            raw_data,
+            self.clean_server_info,
+            self.countries,
+            commit=update_snapshot,
+        )
 
         # Sorting servers by amount of players
         servers.sort(
@@ -175,6 +813,10 @@ class ApiFetcher:
         data = parts.KagServers(
             servers=servers,
             players_amount=players_amount,
+            diff=diff,
+            revision=self.snapshot.revision,
+            by_address={x.address: x for x in servers},
+            timestamp=time(),
         )
 
         log.debug(f"Got following kag servers data: {data}")
@@ -184,27 +826,15 @@ class ApiFetcher:
         """Clean info of provided server"""
         log.debug(f"Attempting to cleanup following server info: {info}")
 
-        country_prefix = None
-        country_name = None
-        if self.known_server_countries:
-            for item in self.known_server_countries:
-                if item["ip"] == info["IPv4Address"]:
-                    country_prefix = item["country"].lower()
-                    country_name = item["name"]
-                    log.debug(
-                        f"Found {item['ip']} in self.known_server_countries"
-                    )
-                    break
-
-        if not country_prefix:
-            country = self.get_country(info["IPv4Address"])
-            with self.countries_locker:
-                self.known_server_countries.append(country)
+        # Countries are expected to be resolved beforehand in a single batch,
+        # see self.resolve_countries()
+        country = self.countries.get(info["IPv4Address"])
+        if country:
             country_prefix = country["country"].lower()
             country_name = country["name"]
-            log.debug(
-                f"Added {info['IPv4Address']} ({country_name}) into storage"
-            )
+        else:
+            country_prefix = UNKNOWN_COUNTRY_PREFIX
+            country_name = UNKNOWN_COUNTRY_NAME
 
         game_mode = info["gameMode"]
         if info["usingMods"]:
@@ -219,6 +849,8 @@ class ApiFetcher:
             link += " (private)"
 
         server_info = parts.KagServerInfo(
+            address=f"{info['IPv4Address']}:{info['port']}",
+            map_id=(info.get("mapW"), info.get("mapH")),
             name=sanitize(info["name"]),
             link=link,
             country_prefix=country_prefix,
@@ -242,28 +874,146 @@ class ApiFetcher:
 
         return server_info
 
-    def get_server(self, ip: str, port: int) -> parts.KagServerInfo:
-        """Get detailed info of requested server with minimap"""
+    def get_cached_server(self, address: str) -> parts.KagServerInfo:
+        """Get info of server with provided address from self.kag_servers.
+        Returns None if there is no such server or snapshot is outdated
+        """
+        data = self.kag_servers
+        if data is None or not data.by_address:
+            return None
+        # Snapshot is considered outdated if it missed its next update
+        if (
+            time() - data.timestamp
+            > self.autoupdate_time + self.request_timeout
+        ):
+            log.debug("Servers snapshot is outdated, not using it")
+            return None
+        return data.by_address.get(address)
+
+    @metrics.FETCHER_CALLS.timed(method="get_server")
+    async def get_server(
+        self,
+        ip: str,
+        port: int,
+        fresh: bool = False,
+    ) -> parts.KagServerInfo:
+        """Get detailed info of requested server with minimap.
+        Info of populated servers is taken from the latest servers snapshot,
+        unless its outdated or fresh info has been explicitly requested
+        """
+        if not fresh:
+            server_info = self.get_cached_server(f"{ip}:{port}")
+            if server_info is not None:
+                log.debug(f"Using info of {ip}:{port} from servers snapshot")
+                # Copying, coz snapshot's entries are shared and shouldnt get
+                # minimaps attached to them
+                server_info = copy_dataclass(server_info)
+                await self.attach_minimap(server_info)
+                return server_info
+
         log.debug(f"Fetching detailed info of {ip}:{port} from kag api")
-        server_info = self.clean_server_info(kag.server.status(ip, port))
-        # Fetching binary minimap separately, coz its not included by default
-        server_info.minimap = BytesIO(kag.server.minimap(ip, port))
+        status = (await self.get_json(f"{KAG_SERVER_URL}/{ip}/{port}/status"))[
+            "serverStatus"
+        ]
+        await self.resolve_countries([status["IPv4Address"]])
+        server_info = self.clean_server_info(status)
+        await self.attach_minimap(server_info)
 
         return server_info
 
-    def get_kagstats(self, player: str) -> parts.KagstatsProfile:
-        """Get player's kagstats profile info (kdr and such)"""
-        log.debug(f"Fetching player profile of {player} from kagstats api")
+    async def attach_minimap(self, server_info: parts.KagServerInfo):
+        """Attach minimap to provided server info.
+        Minimaps are cached for each map of each server, and if there is an
+        url of previously uploaded minimap - it will be used instead
+        """
+        key = (server_info.address, server_info.map_id)
+        url = self.minimap_urls.get(key)
+        if url is not None:
+            log.debug(f"Reusing uploaded minimap of {server_info.address}")
+            server_info.minimap_url = url
+            return
+
+        minimap = await self.minimaps.get_or_fetch(
+            key,
+            lambda: self.get_minimap(*server_info.address.split(":")),
+        )
+        server_info.minimap = BytesIO(minimap)
+
+    async def get_minimap(self, ip: str, port: int) -> bytes:
+        """Get binary minimap of provided server, optimized if configured so"""
+        # Fetching binary minimap separately, coz its not included by default
+        minimap = await self.get_bytes(f"{KAG_SERVER_URL}/{ip}/{port}/minimap")
+        if not self.optimize_minimaps:
+            return minimap
+
+        if self.images_executor is None:
+            self.images_executor = ThreadPoolExecutor(
+                max_workers=DEFAULT_IMAGE_WORKERS,
+                thread_name_prefix="notashark-images",
+            )
         try:
-            data = kagstats.player.stats_by_name(player)
+            return await asyncio.get_running_loop().run_in_executor(
+                self.images_executor,
+                images.optimize_minimap,
+                minimap,
+                *self.minimap_max_size,
+            )
+        except Exception as e:
+            log.warning(f"Unable to optimize minimap of {ip}:{port}: {e}")
+            return minimap
+
+    def remember_minimap_url(self, server_info: parts.KagServerInfo, url: str):
+        """Remember url of uploaded minimap of provided server, to reuse it"""
+        self.minimap_urls.set((server_info.address, server_info.map_id), url)
+
+    @metrics.FETCHER_CALLS.timed(method="get_kagstats")
+    async def get_kagstats(self, player: str) -> parts.KagstatsProfile:
+        """Get player's kagstats profile info (kdr and such).
+        Profiles are cached for a while, thus repeated lookups are instant
+        """
+        key = player.strip().lower()
+        profile_info = await self.profiles.get_or_fetch(
+            key,
+            lambda: self.fetch_kagstats(player),
+        )
+        # Making the same profile available by id, if it has been fetched by
+        # name. Not checking if its there already, to not skew hit ratio
+        player_id = str(profile_info._id)
+        if key != player_id:
+            self.profiles.set(player_id, profile_info)
+
+        return profile_info
+
+    async def fetch_kagstats(self, player: str) -> parts.KagstatsProfile:
+        """Fetch player's kagstats profile info from kagstats api"""
+        log.debug(f"Fetching player profile of {player} from kagstats api")
+        data = None
+        # Numeric values are most likely ids, which makes it possible to fetch
+        # everything at once. Otherwise we need to lookup player's id first
+        if player.isdigit():
+            try:
+                data, hitters, captures = await asyncio.gather(
+                    self.get_json(f"{KAGSTATS_PLAYERS_URL}/{player}/basic"),
+                    self.get_json(f"{KAGSTATS_PLAYERS_URL}/{player}/hitters"),
+                    self.get_json(f"{KAGSTATS_PLAYERS_URL}/{player}/captures"),
+                )
+                player_id = player
+            except aiohttp.ClientResponseError as e:
+                log.debug(f"Unable to find {player} by id ({e}), trying name")
+
+        if data is None:
+            data = await self.get_json(
+                f"{KAGSTATS_PLAYERS_URL}/lookup/{player}"
+            )
             player_id = data["player"]["id"]
-        except:
-            data = kagstats.player.stats_by_id(player)
-            player_id = player
+            hitters, captures = await asyncio.gather(
+                self.get_json(f"{KAGSTATS_PLAYERS_URL}/{player_id}/hitters"),
+                self.get_json(f"{KAGSTATS_PLAYERS_URL}/{player_id}/captures"),
+            )
 
         top_weapons = []
         # coz we only need top-3 weapons
-        for item in kagstats.player.top_weapons(player_id)[0:3]:
+        for item in hitters["hitters"][0:3]:
             top_weapons.append(
                 parts.KillStats(
                     weapon=HITTER_NAMES[item["hitter"]],
@@ -281,19 +1031,17 @@ class ApiFetcher:
             team_kills=data["teamKills"],
             archer_kills=data["archerKills"],
             archer_deaths=data["archerDeaths"],
-            # rounding kdr to always return float like x.xx, to match kagstats ui
-            # using formatter, coz round() would trim multiple zeros to one
-            archer_kdr="%.2f" % (data["archerKills"] / data["archerDeaths"]),
+            archer_kdr=get_kdr(data["archerKills"], data["archerDeaths"]),
             builder_kills=data["builderKills"],
             builder_deaths=data["builderDeaths"],
-            builder_kdr="%.2f" % (data["builderKills"] / data["builderDeaths"]),
+            builder_kdr=get_kdr(data["builderKills"], data["builderDeaths"]),
             knight_kills=data["knightKills"],
             knight_deaths=data["knightDeaths"],
-            knight_kdr="%.2f" % (data["knightKills"] / data["knightDeaths"]),
+            knight_kdr=get_kdr(data["knightKills"], data["knightDeaths"]),
             total_kills=data["totalKills"],
             total_deaths=data["totalDeaths"],
-            total_kdr="%.2f" % (data["totalKills"] / data["totalDeaths"]),
-            captures=kagstats.player.captures(player_id),
+            total_kdr=get_kdr(data["totalKills"], data["totalDeaths"]),
+            captures=int(captures["captures"]),
             top_weapons=top_weapons,
         )
 
@@ -302,28 +1050,50 @@ class ApiFetcher:
         )
         return profile_info
 
-    def get_leaderboard(self, scope: str) -> parts.Leaderboard:
-        """Get leaderboard of provided scope from kagstats api"""
-        # this is probably not the most optimal way to do things, but it works
+    @metrics.FETCHER_CALLS.timed(method="get_leaderboard")
+    async def get_leaderboard(self, scope: str) -> parts.Leaderboard:
+        """Get leaderboard of provided scope.
+        Leaderboards are served from memory, kept up to date by
+        self.leaderboards_routine(). Kagstats api is only queried if requested
+        leaderboard hasnt been fetched yet
+        """
+        leaderboard = self.leaderboards.get(scope)
+        if leaderboard is None:
+            # This will crash on invalid
+            await self.update_leaderboard(scope)
+            leaderboard = self.leaderboards[scope]
+
+        return leaderboard
+
+    async def update_leaderboard(self, scope: str):
+        """Update self.leaderboards with leaderboard of provided scope from
+        kagstats api, if it has changed since last time
+        """
         log.debug(f"Attempting to fetch leaderboard for scope {scope}")
-        # This will crash on invalid
         lb = LEADERBOARD_SCOPES[scope]
+        url = KAGSTATS_LEADERBOARD_URL + lb["path"]
+
+        # Only asking for changes if we already have something to fall back to.
+        # Validators are recorded either way, thus the next update is
+        # conditional
+        if scope not in self.leaderboards:
+            self.validators.pop(url, None)
+        data = await self.get_json_if_modified(url)
+        if data is None:
+            log.debug(f"Leaderboard of scope {scope} didnt change, keeping it")
+            return
 
         # this should already go sorted, no need to do that manually
         players = []
-        # We only need top 3 players, coz thats how kagstats webui work
-        for item in lb["get_leaderboard"]()[0:3]:
-            players.append(
-                parts.LeaderboardEntry(
-                    account=sanitize(item["player"]["username"]),
-                    nickname=sanitize(item["player"]["charactername"]),
-                    clantag=sanitize(item["player"]["clantag"]),
-                    kills=item[lb["kills_slug"]],
-                    deaths=item[lb["deaths_slug"]],
-                    kdr="%.2f"
-                    % (item[lb["kills_slug"]] / item[lb["deaths_slug"]]),
+        # Keeping the whole ranking, to be able to show more than top-3
+        for position, item in enumerate(data["leaderboard"], start=1):
+            try:
+                players.append(self.clean_leaderboard_entry(position, item, lb))
+            except (KeyError, TypeError) as e:
+                log.warning(
+                    f"Skipping malformed entry {position} of {scope} "
+                    f"leaderboard: {type(e).__name__}: {e}"
                 )
-            )
 
         leaderboard = parts.Leaderboard(
             description=lb["description"],
@@ -331,19 +1101,102 @@ class ApiFetcher:
             players=players,
         )
 
+        self.leaderboards[scope] = leaderboard
+        self.notify("leaderboard", scope, leaderboard)
         log.debug(f"Leaderboard of scope {scope} contains: {leaderboard}")
-        return leaderboard
 
-    def autoupdate_routine(self):
+    def clean_leaderboard_entry(
+        self,
+        position: int,
+        item: dict,
+        lb: dict,
+    ) -> parts.LeaderboardEntry:
+        """Clean entry of leaderboard, described by provided LEADERBOARD_SCOPES
+        item
+        """
+        return parts.LeaderboardEntry(
+            position=position,
+            account=sanitize(item["player"]["username"]),
+            nickname=sanitize(item["player"]["charactername"]),
+            clantag=sanitize(item["player"]["clantag"]),
+            kills=item[lb["kills_slug"]],
+            deaths=item[lb["deaths_slug"]],
+            kdr=get_kdr(item[lb["kills_slug"]], item[lb["deaths_slug"]]),
+        )
+
+    def reschedule(self, changed: bool, latency: float, failed: bool = False):
+        """Update self.autoupdate_time with results of servers update, if
+        its picked by scheduler
+        """
+        if self.scheduler is None:
+            return
+
+        interval = round(self.scheduler.record(changed, latency, failed))
+        if interval != self.autoupdate_time:
+            log.debug(f"Servers will be updated each {interval} seconds")
+            self.autoupdate_time = interval
+            self.notify("autoupdate_time", interval)
+
+    def get_backoff_time(self, failures: int) -> float:
+        """Get amount of seconds to wait after provided amount of failed
+        updates in a row. Grows exponentially, with random jitter to avoid
+        retrying in lockstep with other clients of the same api
+        """
+        delay = min(
+            self.autoupdate_time * 2 ** (failures - 1),
+            DEFAULT_MAX_BACKOFF_TIME,
+        )
+        return uniform(delay / 2, delay)
+
+    async def autoupdate_routine(self):
         """Routine that update self.kag_servers with data from self.get_servers().
-        Runs each self.autoupdate_time seconds.
-        Intended to be ran in separate thread on application's launch
+        Runs each self.autoupdate_time seconds. If update fails, it gets
+        retried with exponential backoff, while the last successfully fetched
+        snapshot stays in self.kag_servers.
+        Intended to be ran as asyncio task, see self.start()
         """
+        failures = 0
         while True:
-            # Doing it there, coz its not async rn and this may take a while
-            # And its generally better to use lockers as fast as possible
-            servers = self.get_servers()
-            with self.servers_locker:
-                self.kag_servers = servers
-            log.debug("Successfully updated self.kag_servers")
-            sleep(self.autoupdate_time)
+            started = monotonic()
+            try:
+                self.kag_servers = await self.get_servers(update_snapshot=True)
+            except Exception as e:
+                failures += 1
+                self.reschedule(False, monotonic() - started, failed=True)
+                delay = max(
+                    self.get_backoff_time(failures), self.autoupdate_time
+                )
+                log.warning(
+                    f"Unable to update servers ({failures} failures in a "
+                    f"row), retrying in {delay:.2f} seconds: {e}"
+                )
+            else:
+                failures = 0
+                diff = self.kag_servers.diff
+                self.reschedule(
+                    diff is not None and diff.has_changes,
+                    monotonic() - started,
+                )
+                delay = self.autoupdate_time
+                self.notify("servers", self.kag_servers)
+                log.debug("Successfully updated self.kag_servers")
+            await asyncio.sleep(delay)
+
+    async def leaderboards_routine(self):
+        """Routine that keeps self.leaderboards up to date.
+        Each leaderboard is updated once per self.leaderboards_update_time
+        seconds, with updates of different scopes spread across that time.
+        Intended to be ran as asyncio task, see self.start()
+        """
+        delay = 0
+        while True:
+            for scope in LEADERBOARD_SCOPES:
+                try:
+                    await self.update_leaderboard(scope)
+                except Exception as e:
+                    log.warning(f"Unable to update {scope} leaderboard: {e}")
+                # First pass is done without delays, to warm everything up
+                await asyncio.sleep(delay)
+
+            log.debug("Successfully updated self.leaderboards")
+            delay = self.leaderboards_update_time / len(LEADERBOARD_SCOPES)
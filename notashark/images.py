@@ -0,0 +1,76 @@
+## notashark - discord bot for King Arthur's Gold
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains functions related to processing images.
+# These depend on optional Pillow library and are cpu-bound, thus should be
+# ran in executor
+
+import logging
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+
+def is_available() -> bool:
+    """Check if image processing is possible, e.g if Pillow is installed"""
+
+    return Image is not None
+
+
+def optimize_minimap(
+    data: bytes,
+    max_width: int = None,
+    max_height: int = None,
+) -> bytes:
+    """Re-encode provided png minimap to be as small as possible.
+    If max dimensions are specified - minimap will be downscaled to fit them.
+    Otherwise returns original data, if result didnt end up being smaller
+    """
+
+    with Image.open(BytesIO(data)) as image:
+        image.load()
+        width, height = image.size
+        resized = (max_width and width > max_width) or (
+            max_height and height > max_height
+        )
+        if resized:
+            # thumbnail() keeps aspect ratio and modifies image in place
+            image.thumbnail((max_width or width, max_height or height))
+            log.debug(
+                f"Downscaled minimap from {width}x{height} to {image.size}"
+            )
+
+        # Minimaps tend to have few colors, thus can go as palette losslessly
+        if image.mode == "RGB" and image.getcolors(256) is not None:
+            image = image.convert(
+                "P", palette=Image.Palette.ADAPTIVE, colors=256
+            )
+
+        output = BytesIO()
+        image.save(output, format="PNG", optimize=True)
+
+    result = output.getvalue()
+    if not resized and len(result) >= len(data):
+        log.debug("Optimized minimap is not smaller than original, skipping")
+        return data
+
+    log.debug(f"Optimized minimap from {len(data)} to {len(result)} bytes")
+    return result
@@ -0,0 +1,453 @@
+## notashark - discord bot for King Arthur's Gold
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains everything related to sharing single data fetcher
+# between multiple processes of bot, over unix socket
+
+from notashark import diagnostics, metrics, parts
+from notashark.fetcher import (
+    AsyncApiFetcher,
+    DEFAULT_AUTOUPDATE_TIME,
+    UpstreamUnavailable,
+)
+import asyncio
+import logging
+import pickle
+import signal
+import struct
+from dataclasses import replace
+from os import chmod, remove, umask
+from os.path import exists, join
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FETCHER_SOCKET = join(".", "notashark-fetcher.sock")
+# Max amount of seconds to wait for result of call to fetcher process
+DEFAULT_CALL_TIMEOUT = 60
+# Amount of seconds to wait before attempting to reconnect to fetcher process
+RECONNECT_DELAY = 5
+# Max amount of seconds calls wait for connection to fetcher process. Kept
+# short, thus commands fail fast while fetcher is down
+CONNECT_TIMEOUT = 3
+# Max size of single frame, anything bigger is considered garbage
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Max amount of bytes, queued for single client. Clients that dont read their
+# updates are disconnected, to not grow memory usage of fetcher process
+MAX_CLIENT_BUFFER = 16 * 1024 * 1024
+
+# Each frame is a pickled message, prefixed with its length
+FRAME_HEADER = struct.Struct("!I")
+
+# Methods of AsyncApiFetcher that shard processes are allowed to call
+REMOTE_METHODS = (
+    "get_servers",
+    "get_server",
+    "get_kagstats",
+    "get_leaderboard",
+    "remember_minimap_url",
+)
+
+
+class RemoteError(Exception):
+    """Exception raised in fetcher process, that couldnt be passed as is"""
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """Read single message from provided stream"""
+    (size,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Frame of {size} bytes is too big")
+    return pickle.loads(await reader.readexactly(size))
+
+
+def pack_frame(message) -> bytes:
+    """Pack provided message into frame, ready to be sent"""
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def pack_exception(e: Exception) -> Exception:
+    """Ensure that provided exception can be passed to another process"""
+    try:
+        # Some exceptions can be pickled, but not unpickled back
+        pickle.loads(pickle.dumps(e))
+    except Exception:
+        return RemoteError(f"{type(e).__name__}: {e}")
+    return e
+
+
+class FetcherServer:
+    """Runs data fetcher and shares its data with shard processes.
+    Server snapshots and leaderboards are published to all connected clients
+    as soon as they get updated, everything else is requested on demand.
+    Thus load on upstream apis doesnt depend on amount of shards.
+    Socket is only accessible by its owner, coz messages are pickled
+    """
+
+    def __init__(
+        self,
+        api_fetcher: AsyncApiFetcher = None,
+        socket_file: str = None,
+    ):
+        self.api_fetcher = api_fetcher or AsyncApiFetcher()
+        self.socket_file = socket_file or DEFAULT_FETCHER_SOCKET
+        self.server = None
+        # StreamWriters of connected clients
+        self.clients = set()
+        # Tasks of self.handle_client(), awaited on close
+        self.handlers = set()
+        self.api_fetcher.subscribe(self.publish)
+
+    async def start(self):
+        """Launch data fetcher and start listening for shard processes.
+        Raises RuntimeError if another fetcher process already serves socket
+        """
+        # Removing leftowers of previous run, if there are any. Unless socket
+        # is still alive, coz it would silently cut off running fetcher
+        if exists(self.socket_file):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.socket_file)
+            except (ConnectionRefusedError, FileNotFoundError):
+                remove(self.socket_file)
+            else:
+                writer.close()
+                raise RuntimeError(
+                    f"{self.socket_file} is already served by another fetcher"
+                )
+
+        await self.api_fetcher.start()
+        # Ensuring that socket is never accessible by anybody else
+        old_umask = umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(
+                self.handle_client,
+                path=self.socket_file,
+            )
+        finally:
+            umask(old_umask)
+        chmod(self.socket_file, 0o600)
+        log.info(f"Serving data fetcher on {self.socket_file}")
+
+    async def close(self):
+        """Disconnect clients, stop listening and close data fetcher"""
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.clients):
+                writer.close()
+            # Letting handlers notice disconnect, otherwise they would get
+            # cancelled mid-read once event loop shuts down
+            if self.handlers:
+                await asyncio.wait(list(self.handlers))
+            await self.server.wait_closed()
+            self.server = None
+            if exists(self.socket_file):
+                remove(self.socket_file)
+
+        await self.api_fetcher.close()
+        log.debug("Successfully closed fetcher server")
+
+    def send(self, writer: asyncio.StreamWriter, frame: bytes):
+        """Send provided frame to client, disconnecting it if it lags behind"""
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+            log.warning("Client doesnt keep up with updates, disconnecting")
+            writer.close()
+            return
+        writer.write(frame)
+
+    def publish(self, *update):
+        """Send provided update of api fetcher to all clients"""
+        if not self.clients:
+            return
+        frame = pack_frame(update)
+        for writer in list(self.clients):
+            self.send(writer, frame)
+
+    async def handle_client(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        """Serve single shard process, until it disconnects"""
+        log.info("Shard process has connected")
+        self.clients.add(writer)
+        self.handlers.add(asyncio.current_task())
+
+        # Sharing everything we already have, so client wont need to wait for
+        # next update to get it
+        self.send(
+            writer,
+            pack_frame(("autoupdate_time", self.api_fetcher.autoupdate_time)),
+        )
+        if self.api_fetcher.kag_servers is not None:
+            self.send(
+                writer, pack_frame(("servers", self.api_fetcher.kag_servers))
+            )
+        for scope, leaderboard in self.api_fetcher.leaderboards.items():
+            self.send(writer, pack_frame(("leaderboard", scope, leaderboard)))
+
+        calls = set()
+        try:
+            while True:
+                request_id, method, args = await read_frame(reader)
+                task = asyncio.create_task(
+                    self.handle_call(writer, request_id, method, args)
+                )
+                calls.add(task)
+                task.add_done_callback(calls.discard)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            log.info(f"Shard process has disconnected: {e}")
+        except asyncio.CancelledError:
+            # This is the outermost coroutine of its task, thus there is
+            # nobody to propagate cancellation to
+            log.debug("Serving of shard process has been cancelled")
+        except Exception as e:
+            log.warning(f"Unable to process request of shard process: {e}")
+        finally:
+            self.clients.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            for task in calls:
+                task.cancel()
+            writer.close()
+
+    async def handle_call(
+        self,
+        writer: asyncio.StreamWriter,
+        request_id: int,
+        method: str,
+        args: tuple,
+    ):
+        """Call method of api fetcher and send its result back to client.
+        Calls without request_id dont expect any result
+        """
+        log.debug(f"Shard process has called {method}{args}")
+        try:
+            if method not in REMOTE_METHODS:
+                raise RemoteError(f"Unable to call {method}")
+            result = getattr(self.api_fetcher, method)(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except Exception as e:
+            log.debug(f"Call of {method}{args} has failed: {e}")
+            reply = ("error", request_id, pack_exception(e))
+        else:
+            reply = ("result", request_id, result)
+
+        if request_id is None:
+            return
+        try:
+            self.send(writer, pack_frame(reply))
+            await writer.drain()
+        except ConnectionError as e:
+            log.debug(f"Unable to send result of {method}: {e}")
+
+
+async def serve_fetcher(
+    server: FetcherServer,
+    metrics_server: metrics.MetricsServer = None,
+    loop_profiler: diagnostics.LoopProfiler = None,
+):
+    """Run provided fetcher server until SIGTERM or SIGINT is received"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    if loop_profiler is not None:
+        loop_profiler.start()
+    await server.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    try:
+        await stop.wait()
+    finally:
+        log.info("Shutting down fetcher server")
+        await server.close()
+        if metrics_server is not None:
+            await metrics_server.close()
+        if loop_profiler is not None:
+            loop_profiler.close()
+
+
+class RemoteApiFetcher:
+    """Drop-in replacement of AsyncApiFetcher, getting data from FetcherServer
+    in another process, instead of querying apis by itself
+    """
+
+    def __init__(
+        self,
+        socket_file: str = None,
+        autoupdate_time: int = None,
+        call_timeout: int = None,
+    ):
+        self.socket_file = socket_file or DEFAULT_FETCHER_SOCKET
+        # Used by the bot to decide how often to update serverlists. Replaced
+        # by actual value of fetcher process, once connected
+        self.autoupdate_time = autoupdate_time or DEFAULT_AUTOUPDATE_TIME
+        self.call_timeout = call_timeout or DEFAULT_CALL_TIMEOUT
+        # Kept up to date by updates, published by fetcher process
+        self.kag_servers = None
+        self.leaderboards = {}
+        # These can only be created from within running event loop,
+        # thus they are initialized in self.start()
+        self.connected = None
+        self.connection_task = None
+        self.writer = None
+        # request_id: future, awaiting result of that request
+        self.pending = {}
+        self.last_request_id = 0
+
+    async def start(self):
+        """Start connecting to fetcher process.
+        Must be called from within running event loop
+        """
+        if self.connection_task is None or self.connection_task.done():
+            self.connected = asyncio.Event()
+            self.connection_task = asyncio.create_task(
+                self.connection_routine()
+            )
+
+    async def close(self):
+        """Disconnect from fetcher process"""
+        if self.connection_task is not None:
+            self.connection_task.cancel()
+            try:
+                await self.connection_task
+            except asyncio.CancelledError:
+                pass
+            self.connection_task = None
+        log.debug("Successfully closed remote api fetcher")
+
+    async def connection_routine(self):
+        """Routine that keeps connection to fetcher process, reconnecting to
+        it if its lost. Intended to be ran as asyncio task, see self.start()
+        """
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.socket_file
+                )
+            except OSError as e:
+                log.warning(
+                    f"Unable to connect to fetcher on {self.socket_file}: {e}"
+                )
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            log.info(f"Connected to fetcher on {self.socket_file}")
+            self.writer = writer
+            self.connected.set()
+            try:
+                while True:
+                    self.dispatch(await read_frame(reader))
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                log.warning(f"Lost connection to fetcher: {e}")
+            finally:
+                self.connected.clear()
+                self.writer = None
+                writer.close()
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(
+                            ConnectionError("Lost connection to fetcher")
+                        )
+                self.pending.clear()
+
+    def dispatch(self, message: tuple):
+        """Process single message, received from fetcher process"""
+        kind = message[0]
+        if kind == "servers":
+            self.kag_servers = message[1]
+        elif kind == "leaderboard":
+            self.leaderboards[message[1]] = message[2]
+        elif kind == "autoupdate_time":
+            self.autoupdate_time = message[1]
+        elif kind in ("result", "error"):
+            future = self.pending.pop(message[1], None)
+            if future is None or future.done():
+                return
+            if kind == "result":
+                future.set_result(message[2])
+            else:
+                future.set_exception(message[2])
+        else:
+            log.warning(f"Received message of unknown kind: {kind}")
+
+    def send(self, request_id: int, method: str, *args):
+        """Send call of provided method to fetcher process"""
+        if self.writer is None:
+            raise ConnectionError("Not connected to fetcher")
+        self.writer.write(pack_frame((request_id, method, args)))
+
+    async def call(self, method: str, *args):
+        """Call provided method of fetcher process and wait for its result.
+        Raises UpstreamUnavailable if fetcher process is down
+        """
+        if not self.connected.is_set():
+            try:
+                await asyncio.wait_for(self.connected.wait(), CONNECT_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise UpstreamUnavailable("Fetcher process is unavailable")
+
+        self.last_request_id += 1
+        request_id = self.last_request_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.send(request_id, method, *args)
+            return await asyncio.wait_for(future, self.call_timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def get_servers(self) -> parts.KagServers:
+        """Get fresh info about populated servers"""
+        return await self.call("get_servers")
+
+    async def get_server(
+        self,
+        ip: str,
+        port: int,
+        fresh: bool = False,
+    ) -> parts.KagServerInfo:
+        """Get detailed info of requested server with minimap"""
+        return await self.call("get_server", ip, port, fresh)
+
+    async def get_kagstats(self, player: str) -> parts.KagstatsProfile:
+        """Get player's kagstats profile info.
+        Profiles are cached by fetcher process, thus shared by all shards
+        """
+        return await self.call("get_kagstats", player)
+
+    async def get_leaderboard(self, scope: str) -> parts.Leaderboard:
+        """Get leaderboard of provided scope, published by fetcher process"""
+        leaderboard = self.leaderboards.get(scope)
+        if leaderboard is None:
+            leaderboard = await self.call("get_leaderboard", scope)
+        return leaderboard
+
+    def remember_minimap_url(self, server_info: parts.KagServerInfo, url: str):
+        """Share url of uploaded minimap of provided server with all shards"""
+        try:
+            # There is no need to send minimap itself
+            self.send(
+                None,
+                "remember_minimap_url",
+                replace(server_info, minimap=None),
+                url,
+            )
+        except ConnectionError as e:
+            log.debug(f"Unable to share minimap url: {e}")
@@ -0,0 +1,335 @@
+## notashark - discord bot for King Arthur's Gold
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains minimal prometheus-style metrics of the bot, and http
+# server to expose them. Metrics are always collected, coz its cheap, but only
+# served if asked to
+
+import asyncio
+import logging
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+DEFAULT_METRICS_HOST = "127.0.0.1"
+# Amount of seconds between measurements of event loop's lag
+LOOP_LAG_INTERVAL = 1
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def format_labels(labels: dict) -> str:
+    """Format provided labels the way prometheus expects them"""
+    if not labels:
+        return ""
+    items = []
+    for key, value in labels.items():
+        value = (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n")
+        )
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+class Metric:
+    """Base of all metrics. Values are stored per combination of labels"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        # tuple of label values: value
+        self.values = {}
+
+    def get_key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(x, "")) for x in self.labels)
+
+    def samples(self):
+        """Yield (suffix, labels, value) of each sample of this metric"""
+        for key, value in self.values.items():
+            yield "", dict(zip(self.labels, key)), value
+
+    def render(self) -> str:
+        """Render metric in prometheus text format"""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Value that can only grow"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down. If function is provided - its called on
+    each render and should return {tuple of label values: value}
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple = (),
+        function=None,
+    ):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        self.values[self.get_key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                self.values = self.function()
+            except Exception as e:
+                log.warning(f"Unable to collect {self.name}: {e}")
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    """Distribution of observed values, such as durations"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple = (),
+        buckets: tuple = None,
+    ):
+        super().__init__(name, description, labels)
+        # Duplicated bounds would produce duplicated series, which prometheus
+        # refuses to scrape
+        self.buckets = tuple(sorted(set(buckets or DEFAULT_BUCKETS)))
+
+    def observe(self, value: float, **labels):
+        key = self.get_key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # Counts of values in each bucket (+Inf goes last), sum, count
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe duration of code within this context manager"""
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started, **labels)
+
+    def timed(self, **labels):
+        """Decorator, observing duration of each call of coroutine function"""
+
+        def decorator(function):
+            @wraps(function)
+            async def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return await function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, amount in zip(self.buckets + ("+Inf",), counts):
+                cumulative += amount
+                yield "_bucket", {**labels, "le": bound}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class Registry:
+    """Collection of metrics, rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        return "\n".join(x.render() for x in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# name: cache with hits and misses counters, e.g cache.TTLCache
+CACHES = {}
+
+
+def register_cache(name: str, cache):
+    """Expose hit ratio of provided cache"""
+    CACHES[name] = cache
+
+
+def get_cache_hit_ratios() -> dict:
+    ratios = {}
+    for name, cache in CACHES.items():
+        total = cache.hits + cache.misses
+        ratios[(name,)] = (cache.hits / total) if total else 0
+    return ratios
+
+
+UPSTREAM_REQUESTS = REGISTRY.histogram(
+    "notashark_upstream_request_seconds",
+    "Duration of requests to upstream apis",
+    ("upstream", "outcome"),
+)
+FETCHER_CALLS = REGISTRY.histogram(
+    "notashark_fetcher_call_seconds",
+    "Duration of data fetcher calls, including cached ones",
+    ("method",),
+)
+COMMANDS = REGISTRY.histogram(
+    "notashark_command_seconds",
+    "Duration of bot's commands",
+    ("command", "kind", "outcome"),
+)
+SERVERLIST_PASSES = REGISTRY.histogram(
+    "notashark_serverlist_pass_seconds",
+    "Duration of passes, updating serverlists on all guilds",
+    buckets=DEFAULT_BUCKETS + (120, 300),
+)
+SERVERLIST_GUILDS = REGISTRY.counter(
+    "notashark_serverlist_guilds_total",
+    "Amount of guilds processed by serverlist update passes",
+    ("result",),
+)
+SERVERLIST_EDITS = REGISTRY.histogram(
+    "notashark_serverlist_edit_seconds",
+    "Duration of edits and creations of serverlist messages",
+    ("action",),
+)
+CACHE_HIT_RATIO = REGISTRY.gauge(
+    "notashark_cache_hit_ratio",
+    "Ratio of cache lookups that have been served from cache",
+    ("cache",),
+    function=get_cache_hit_ratios,
+)
+LOOP_LAG = REGISTRY.histogram(
+    "notashark_event_loop_lag_seconds",
+    "Delay of event loop's callbacks, compared to their scheduled time",
+    buckets=(0.001,) + DEFAULT_BUCKETS[:8],
+)
+
+
+async def loop_lag_routine(interval: float = None):
+    """Routine that measures lag of running event loop.
+    Intended to be ran as asyncio task, see MetricsServer.start()
+    """
+    interval = interval or LOOP_LAG_INTERVAL
+    while True:
+        started = monotonic()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(monotonic() - started - interval, 0))
+
+
+class MetricsServer:
+    """Http server exposing metrics on /metrics"""
+
+    def __init__(
+        self,
+        port: int,
+        host: str = None,
+        registry: Registry = None,
+    ):
+        self.port = port
+        self.host = host or DEFAULT_METRICS_HOST
+        self.registry = registry or REGISTRY
+        # These can only be created from within running event loop,
+        # thus they are initialized in self.start()
+        self.runner = None
+        self.loop_lag_task = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.registry.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+        )
+
+    async def start(self):
+        """Start serving metrics and measuring event loop's lag"""
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.loop_lag_task = asyncio.create_task(loop_lag_routine())
+        log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        """Stop serving metrics"""
+        if self.loop_lag_task is not None:
+            self.loop_lag_task.cancel()
+            self.loop_lag_task = None
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -23,10 +23,30 @@ from discord import Embed, File
 log = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True)
+class ServersDiff:
+    # Addresses (ip:port) of servers, affected by each kind of change
+    added: list
+    removed: list
+    changed: list
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
 @dataclass(frozen=True)
 class KagServers:
     servers: list
     players_amount: int = 0
+    # Difference from previous snapshot, if there was any
+    diff: ServersDiff = None
+    # Incremented each time snapshot's content changes
+    revision: int = 0
+    # "ip:port": KagServerInfo of the same servers, for lookups by address
+    by_address: dict = None
+    # Unix time of moment this snapshot has been fetched at
+    timestamp: float = None
 
 
 # Not frozen coz of minimap
@@ -41,6 +61,11 @@ class KagServerInfo:
     capacity: str
     nicknames: str
     minimap: bytes = None
+    address: str = None
+    # Things that change when server switches map. Used to cache minimaps
+    map_id: tuple = None
+    # Url of previously uploaded minimap, that can be used instead of minimap
+    minimap_url: str = None
 
 
 # I should probably also add nemesis/bullied players #TODO
@@ -75,9 +100,9 @@ class KillStats:
     kills: int
 
 
-# Not frozen due to position
-@dataclass
+@dataclass(frozen=True)
 class LeaderboardEntry:
+    position: int
     account: str
     nickname: str
     clantag: str
@@ -16,51 +16,269 @@
 
 # This module contains everything related to working with per-guild settings
 
+import asyncio
 import logging
 import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from os import fsync, replace
 from os.path import join
-from time import sleep
+from threading import Lock
+from time import monotonic
 
 log = logging.getLogger(__name__)
 
+# Max amount of seconds changes to settings may stay unsaved
 DEFAULT_AUTOSAVE_TIME = 300
+# Amount of seconds without changes, after which settings get saved
+DEFAULT_SAVE_DELAY = 5
 DEFAULT_SETTINGS_FILE = join(".", "settings.json")
+DEFAULT_SETTINGS_DB = join(".", "settings.db")
+
+# Names of per-guild settings, in order of columns of sqlite table
+SETTINGS_FIELDS = ("serverlist_channel_id", "serverlist_message_id")
+
+
+class JsonBackend:
+    """Settings storage backend, keeping everything in single json file.
+    Each save rewrites the whole file
+    """
+
+    def __init__(self, settings_file: str = None):
+        self.settings_file = settings_file or DEFAULT_SETTINGS_FILE
+
+    def load(self) -> dict:
+        """Get settings of all guilds from settings file"""
+        with open(self.settings_file, "r") as j:
+            data = json.load(j)
+        log.debug(
+            f"Fetched following settings from {self.settings_file}: {data}"
+        )
+        return data
+
+    def snapshot(self, storage: dict, changed: set) -> dict:
+        """Get copy of settings that need to be saved"""
+        return {guild_id: dict(entry) for guild_id, entry in storage.items()}
+
+    def save(self, data: dict):
+        """Save provided snapshot of settings into json file.
+        Data is written into temporary file first, which then replaces the
+        original one. Thus crash in process wont leave settings corrupted
+        """
+        jdata = json.dumps(data)
+        tmp_filepath = f"{self.settings_file}.tmp"
+        with open(tmp_filepath, "w") as f:
+            f.write(jdata)
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp_filepath, self.settings_file)
+
+    def close(self):
+        """Release resources used by backend"""
+
+
+class SqliteBackend:
+    """Settings storage backend, keeping each guild in separate row of sqlite
+    database. Each save only writes rows of changed guilds
+    """
+
+    def __init__(self, db_file: str = None):
+        self.settings_file = db_file or DEFAULT_SETTINGS_DB
+        # Connection is shared with writer's thread, thus access to it is
+        # guarded with lock
+        self.locker = Lock()
+        self.connection = sqlite3.connect(
+            self.settings_file,
+            check_same_thread=False,
+        )
+        with self.locker, self.connection as c:
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.execute(
+                "CREATE TABLE IF NOT EXISTS guilds ("
+                "guild_id TEXT PRIMARY KEY, "
+                "serverlist_channel_id INTEGER, "
+                "serverlist_message_id INTEGER)"
+            )
+            c.execute(
+                "CREATE INDEX IF NOT EXISTS guilds_serverlist_channel_id "
+                "ON guilds (serverlist_channel_id)"
+            )
+
+    def load(self) -> dict:
+        """Get settings of all guilds from database"""
+        with self.locker:
+            rows = self.connection.execute(
+                "SELECT guild_id, serverlist_channel_id, serverlist_message_id "
+                "FROM guilds"
+            ).fetchall()
+        log.debug(f"Fetched {len(rows)} entries from {self.settings_file}")
+        return {row[0]: dict(zip(SETTINGS_FIELDS, row[1:])) for row in rows}
+
+    def snapshot(self, storage: dict, changed: set) -> list:
+        """Get rows of changed guilds that need to be saved"""
+        rows = []
+        for guild_id in changed:
+            entry = storage.get(guild_id)
+            if entry is not None:
+                rows.append(
+                    (guild_id,) + tuple(entry[i] for i in SETTINGS_FIELDS)
+                )
+        return rows
+
+    def save(self, rows: list):
+        """Upsert provided rows of changed guilds into database"""
+        with self.locker, self.connection as c:
+            c.executemany(
+                "INSERT INTO guilds "
+                "(guild_id, serverlist_channel_id, serverlist_message_id) "
+                "VALUES (?, ?, ?) "
+                "ON CONFLICT (guild_id) DO UPDATE SET "
+                "serverlist_channel_id = excluded.serverlist_channel_id, "
+                "serverlist_message_id = excluded.serverlist_message_id",
+                rows,
+            )
+
+    def close(self):
+        """Release resources used by backend"""
+        with self.locker:
+            self.connection.close()
+
+
+def migrate_settings(settings_file: str = None, db_file: str = None) -> int:
+    """Import settings from json file into sqlite database.
+    Returns amount of imported entries
+    """
+    storage = JsonBackend(settings_file).load()
+    backend = SqliteBackend(db_file)
+    try:
+        backend.save(backend.snapshot(storage, set(storage)))
+    finally:
+        backend.close()
+
+    return len(storage)
 
 
 class SettingsManager:
     """Everything related to settings loading, updating and saving"""
 
-    def __init__(self, settings_file: str = None, autosave_time: int = None):
-        self.settings_file = settings_file or DEFAULT_SETTINGS_FILE
+    def __init__(
+        self,
+        settings_file: str = None,
+        autosave_time: int = None,
+        save_delay: int = None,
+        backend=None,
+    ):
+        # If no backend has been specified - sticking to json one
+        self.backend = backend or JsonBackend(settings_file)
+        self.settings_file = self.backend.settings_file
         self.autosave_time = autosave_time or DEFAULT_AUTOSAVE_TIME
+        self.save_delay = save_delay or DEFAULT_SAVE_DELAY
         self.storage = {}
+        # Dirty tracking. Changes to self.storage should be reported via
+        # self.mark_dirty(), otherwise they wont be saved. Storage itself
+        # should only be modified from within event loop
+        self.changed = None
+        self.dirty = set()
+        self.first_change_time = None
+        self.last_change_time = None
+        # Single worker, thus writes are done one by one, in order of flushes
+        self.executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="settings",
+        )
+        self.autosave_task = None
         self.load_settings()
 
-    def get_settings(self, filepath: str = None) -> dict:
-        """Get settings from provided file"""
-        filepath = filepath or self.settings_file
-        with open(filepath, "r") as j:
-            data = json.load(j)
-        log.debug(f"Fetched following settings from {filepath}: {data}")
-        return data
+    def start(self):
+        """Launch autosave routine. Should be called from within event loop"""
+        # Event is created there, coz on py3.8-3.9 it would be bound to
+        # the wrong loop otherwise
+        self.changed = asyncio.Event()
+        if self.dirty:
+            self.changed.set()
+        self.autosave_task = asyncio.create_task(self.autosave_routine())
+
+    async def close(self):
+        """Stop autosave routine, save unsaved changes and release storage"""
+        if self.autosave_task is not None:
+            self.autosave_task.cancel()
+            # Letting in-flight save to return its changes into self.dirty
+            with suppress(asyncio.CancelledError):
+                await self.autosave_task
+            self.autosave_task = None
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.backend.close)
+        self.executor.shutdown()
 
-    def load_settings(self, filepath: str = None):
+    def load_settings(self):
         """Load settings into self.storage"""
         try:
-            settings = self.get_settings(filepath)
+            settings = self.backend.load()
         except Exception as e:
-            log.error(f"Unable to load settings from {filepath}: {e}")
+            log.error(f"Unable to load settings from {self.settings_file}: {e}")
         else:
             self.storage = settings
 
-    def save_settings(self, filepath: str = None):
-        """Save self.storage into json file"""
-        filepath = filepath or self.settings_file
-        jdata = json.dumps(self.storage)
-        with open(filepath, "w") as f:
-            f.write(jdata)
+    def mark_dirty(self, *guild_ids: str):
+        """Report that entries of provided guilds have been changed"""
+        now = monotonic()
+        if not self.dirty:
+            self.first_change_time = now
+        self.dirty.update(guild_ids)
+        self.last_change_time = now
+        if self.changed is not None:
+            self.changed.set()
+
+    async def flush(self):
+        """Save settings, if there are any unsaved changes"""
+        if self.changed is not None:
+            self.changed.clear()
+        if not self.dirty:
+            return
 
-        log.debug(f"Successfully saved settings to {filepath}")
+        # Snapshot is taken without awaiting, thus its consistent. Changes
+        # made during save will get into the next one
+        changed = self.dirty
+        self.dirty = set()
+        data = self.backend.snapshot(self.storage, changed)
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.backend.save, data)
+        except asyncio.CancelledError:
+            # Save may still be in progress, but its outcome is unknown. Its
+            # safe to save these entries again, coz saves are idempotent
+            self.mark_dirty(*changed)
+            raise
+        except Exception as e:
+            log.critical(
+                f"Unable to save settings to {self.settings_file}: {e}"
+            )
+            # Trying again later
+            self.mark_dirty(*changed)
+        else:
+            log.info(
+                f"Successfully saved {len(changed)} changed entries into "
+                f"{self.settings_file}"
+            )
+
+    def set_serverlist_channel(self, guild_id: str, channel_id: int):
+        """Set serverlist channel of provided guild, resetting its message"""
+        guild_id = str(guild_id)
+        self.add_entry(guild_id)
+        self.storage[guild_id]["serverlist_channel_id"] = channel_id
+        # resetting message id, in case its already been set in past
+        self.storage[guild_id]["serverlist_message_id"] = None
+        self.mark_dirty(guild_id)
+
+    def set_serverlist_message(self, guild_id: str, message_id: int):
+        """Set id of serverlist message of provided guild"""
+        guild_id = str(guild_id)
+        self.storage[guild_id]["serverlist_message_id"] = message_id
+        self.mark_dirty(guild_id)
 
     def add_entry(
         self,
@@ -81,28 +299,30 @@ class SettingsManager:
             x["serverlist_message_id"] = serverlist_message_id
             # idk if this needs more settings
             self.storage[guild_id] = x
-            # Im not sure if this may go into race condition situation
-            # if called for multiple servers at once. Hopefully not
+            self.mark_dirty(guild_id)
             log.debug(f"Now settings storage looks like: {self.storage}")
             return
 
         log.debug(f"{guild_id} is already in storage, no need to add again")
 
-    def autosave_routine(self):
-        """Routine that runs self.save_settings() each self.autosave_time seconds.
-        Intended to be ran in separate thread on application's launch
+    async def autosave_routine(self):
+        """Routine that saves settings once they have been changed.
+        Saving happens after self.save_delay seconds without new changes, but
+        no later than self.autosave_time seconds after the first unsaved one.
+        Without changes, nothing is written at all.
         """
 
         while True:
-            log.debug(f"Waiting {self.autosave_time} seconds before next save")
-            sleep(self.autosave_time)
-            try:
-                self.save_settings()
-            except Exception as e:
-                log.critical(
-                    f"Unable to save settings to {self.settings_file}: {e}"
-                )
-            else:
-                log.info(
-                    f"Successfully saved settings into {self.settings_file}"
+            await self.changed.wait()
+            while self.dirty:
+                save_time = min(
+                    self.last_change_time + self.save_delay,
+                    self.first_change_time + self.autosave_time,
                 )
+                delay = save_time - monotonic()
+                if delay <= 0:
+                    break
+                log.debug(f"Waiting {delay:.2f} seconds before next save")
+                await asyncio.sleep(delay)
+
+            await self.flush()
@@ -22,8 +22,11 @@ setup(
     install_requires=[
         "pykagapi==0.2.1",
         "discord.py==2.1.0",
-        "requests==2.28.1",
+        "aiohttp>=3.7.4,<4",
     ],
+    extras_require={
+        "images": ["Pillow>=9.1"],
+    },
     entry_points={
         "console_scripts": ["notashark = notashark:cli.main"],
     },